@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from objectives import dcp_loss, mdcp_loss, l21_loss
+from precision import PrecisionPolicy
+from profiling import span
 
 class MlpBlock(nn.Module):
     def __init__(self, d_in, hidden, d_out):
@@ -102,7 +104,9 @@ def _weighted_sum(tensors, weights, normalize_weights=True):
     return out
 
 class DCP(nn.Module):
-    def __init__(self, in_size, hidden_size, out_size, view, cca_dim, r, device, n_iter=15, dcc_solver='pytorch', dcc_dtype=torch.float32, dec_loss_type='l21', twoview=False):
+    def __init__(self, in_size, hidden_size, out_size, view, cca_dim, r, device, n_iter=15, dcc_solver='pytorch', dcc_dtype=torch.float32, dec_loss_type='l21', twoview=False, dcc_tol=None,
+                 whitening_method='eigh', whitening_cache_tol=None, packed=False, precision=None, whitening_ns_iter=30,
+                 whitening_cache_every=1, dcc_tol_every=1):
         super(DCP, self).__init__()
         self.Enc = Encoder(in_size, hidden_size, out_size)
         self.Dec = Decoder(out_size, hidden_size, in_size)
@@ -115,14 +119,15 @@ class DCP(nn.Module):
         self.device = device
         self.dec_loss_type = dec_loss_type
         self.twoview = twoview
+        self.packed = packed
+        self.precision = precision if precision is not None else PrecisionPolicy(device, solver_dtype=dcc_dtype)
 
-        if twoview:
-            self.dcp_loss = dcp_loss(cca_dim, r, device, dcc_dtype).loss
-        else:
-            if dcc_solver == 'numpy':
-                self.dcp_loss = mdcp_loss(cca_dim, r, device, n_iter, dcc_dtype).loss_numpy_fast
-            else:
-                self.dcp_loss = mdcp_loss(cca_dim, r, device, n_iter, dcc_dtype).loss
+        self.dcc_args = dict(r=r, n_iter=n_iter, dcc_solver=dcc_solver, dcc_dtype=self.precision.solver_dtype, dcc_tol=dcc_tol,
+                             dcc_tol_every=dcc_tol_every,
+                             whitening_method=whitening_method, whitening_cache_tol=whitening_cache_tol,
+                             whitening_ns_iter=whitening_ns_iter, whitening_cache_every=whitening_cache_every)
+        self.dcc_solvers = []
+        self.dcp_loss = self.make_dcp_loss(view)
         if dec_loss_type == 'l21':
             self.l21_loss = l21_loss().loss
         elif dec_loss_type == 'mse':
@@ -130,33 +135,116 @@ class DCP(nn.Module):
         else:
             raise "unknown decoder loss"
 
+    def make_dcp_loss(self, view):
+        r = self.dcc_args['r']
+        dcc_dtype = self.dcc_args['dcc_dtype']
+        whitening_method = self.dcc_args['whitening_method']
+        whitening_cache_tol = self.dcc_args['whitening_cache_tol']
+        whitening_args = dict(whitening_ns_iter=self.dcc_args['whitening_ns_iter'],
+                              whitening_cache_every=self.dcc_args['whitening_cache_every'])
+        if self.twoview:
+            solver = dcp_loss(self.cca_dim, r, self.device, dcc_dtype, whitening_method, whitening_cache_tol,
+                              **whitening_args)
+            self.dcc_solvers.append(solver)
+            return eager(solver.loss)
+
+        solver = mdcp_loss(self.cca_dim, r, self.device, self.dcc_args['n_iter'], dcc_dtype, tol=self.dcc_args['dcc_tol'],
+                           whitening_method=whitening_method, whitening_cache_tol=whitening_cache_tol,
+                           tol_every=self.dcc_args['dcc_tol_every'], **whitening_args)
+        self.dcc_solvers.append(solver)
+        if self.dcc_args['dcc_solver'] == 'numpy':
+            loss = solver.loss_numpy_fast
+        elif self.dcc_args['dcc_solver'] == 'block':
+            loss = solver.loss_block
+        else:
+            loss = solver.loss
+        # Early stopping and the whitening cache give data dependent control flow, so the covariation
+        # solve always runs eagerly, also when the surrounding module is compiled
+        return eager(loss)
+
     def forward(self, x):
+        eo, dec_loss = self.encode(x, self.view)
+        with span('covariation'):
+            dcp_loss, W = self.dcp_loss(eo)
+        # The projections of the last pass map new samples of the same features (see inference.Predictor)
+        self.W = [w.detach() for w in W]
+        fused = self.fuse(self.fusion, x, W)
+        return eo, fused, dcp_loss, sum(dec_loss)
+
+    def solver_state_dict(self):
+        """
+        Whitening caches of the covariation solvers, which carry over between forward passes.
+        """
+        return [solver.whitening.state_dict() for solver in self.dcc_solvers]
+
+    def load_solver_state_dict(self, state):
+        for solver, solver_state in zip(self.dcc_solvers, state):
+            solver.whitening.load_state_dict(solver_state)
+
+    def heads(self):
+        """
+        (fusion, projections of the last forward pass) of every output.
+        """
+        return [(self.fusion, self.W)]
+
+    def encode(self, x, n_view):
+        """
+        Encode and reconstruct the first `n_view` views.
+
+        The encoder and decoder act on every row (feature) independently, so with `packed` all views
+        are stacked along the rows and pass through them in one call, then split again. The larger
+        matmuls round differently, so embeddings and decoder losses only match the per-view loop to
+        float32 precision (~1e-7). The fused outputs can differ much more: the covariation components
+        past the embedding size are rounding noise that these differences change.
+        They run in the MLP precision of `precision`, their outputs are cast back to float32 once.
+
+        :return: Encoder outputs and decoder losses of every view
+        """
+        if self.packed:
+            sizes = [x[v].shape[0] for v in range(n_view)]
+            with self.precision.mlp():
+                with span('encode'):
+                    eot, eoh = self.Enc(torch.cat(x[:n_view], dim=0))
+                with span('decode'):
+                    dot, doh = self.Dec(eot)
+            eot, eoh, dot, doh = self.precision.output(eot, eoh, dot, doh)
+            eo = list(torch.split(eot, sizes))
+            eh = torch.split(eoh, sizes)
+            do = torch.split(dot, sizes)
+            dh = torch.split(doh, sizes)
+            dec_loss = [self.dec_loss(x[v], eh[v], do[v], dh[v]) for v in range(n_view)]
+            return eo, dec_loss
+
         eo = []
         eh = []
         do = []
         dh = []
 
-        dec_loss = 0
-        for v in range(self.view):
-            eot, eoh = self.Enc(x[v])
+        dec_loss = []
+        for v in range(n_view):
+            with self.precision.mlp():
+                with span('encode'):
+                    eot, eoh = self.Enc(x[v])
+                with span('decode'):
+                    dot, doh = self.Dec(eot)
+            eot, eoh, dot, doh = self.precision.output(eot, eoh, dot, doh)
             eo.append(eot)
             eh.append(eoh)
 
-            dot, doh = self.Dec(eot)
             do.append(dot)
             dh.append(doh)
 
-            dec_loss += self.dec_loss(x[v], eoh, dot, doh)
+            dec_loss.append(self.dec_loss(x[v], eoh, dot, doh))
+        return eo, dec_loss
 
-        dcp_loss, W = self.dcp_loss(eo)
-        c_list = []
-        for v in range(self.view):
-            wt = torch.tensor(W[v], dtype=torch.float32, device=self.device)
-            ct = torch.matmul(wt.t(), x[v])
-            c_list.append(ct)
-        tfused = torch.cat(c_list, dim=0)
-        fused = self.fusion(tfused.t())
-        return eo, fused, dcp_loss, dec_loss
+    def fuse(self, fusion, x, W):
+        with span('fusion'):
+            c_list = []
+            for v in range(len(W)):
+                ct = torch.matmul(W[v].t(), x[v])
+                c_list.append(ct)
+            tfused = torch.cat(c_list, dim=0)
+            return fusion(tfused.t())
 
     def dec_loss(self, x, eh, do, dh):
         if self.dec_loss_type == 'l21':
@@ -170,3 +258,74 @@ class DCP(nn.Module):
 
         loss = loss1 + loss2
         return loss
+
+class MultiHeadDCP(DCP):
+    """
+    DCP heads over nested view subsets that share one encoder and decoder.
+
+    Head h covers the first `views[h]` views. Every view is encoded and decoded once per forward
+    pass, then each head runs its own covariation solve and fusion on the shared embeddings.
+    `forward` returns one (eo, fused, dcp_loss, dec_loss) tuple per head, as `DCP` would.
+
+    :param views: Number of views of every head, e.g. [n_view - 1, n_view] for the old and new model
+    """
+    def __init__(self, in_size, hidden_size, out_size, views, cca_dim, r, device, **kwargs):
+        super(MultiHeadDCP, self).__init__(in_size, hidden_size, out_size, max(views), cca_dim, r, device, **kwargs)
+        self.views = list(views)
+        self.fusion = nn.ModuleList([
+            nn.Sequential(nn.Linear(cca_dim*view, cca_dim, bias=True)) for view in self.views
+        ])
+        self.dcc_solvers = []
+        self.dcp_loss = [self.make_dcp_loss(view) for view in self.views]
+
+    def forward(self, x):
+        eo, dec_loss = self.encode(x, self.view)
+        out = []
+        self.W = []
+        for h, view in enumerate(self.views):
+            with span('covariation'):
+                dcp_loss, W = self.dcp_loss[h](eo[:view])
+            self.W.append([w.detach() for w in W])
+            fused = self.fuse(self.fusion[h], x, W)
+            out.append((eo[:view], fused, dcp_loss, sum(dec_loss[:view])))
+        return out
+
+    def heads(self):
+        return list(zip(self.fusion, self.W))
+
+def eager(fn):
+    """
+    `fn` excluded from torch.compile graphs, always run eagerly.
+    """
+    if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'disable'):
+        return torch.compiler.disable(fn)
+    # torch.compiler is only available from torch 2.1 on
+    return torch._dynamo.disable(fn)
+
+
+def compile_model(model, mode=None, backend='inductor'):
+    """
+    Compile the Encoder, Decoder, MlpBlock, DDC and WeightedMean modules of `model` in place with
+    torch.compile. Blocks inside an already compiled module are left to their parent, the covariation
+    solvers of DCP always run eagerly (see DCP.make_dcp_loss).
+
+    :param model: Module to compile, or one of the compiled module types itself
+    :param mode: torch.compile mode, e.g. 'default', 'reduce-overhead' or 'max-autotune'
+    :param backend: torch.compile backend, 'inductor' also generates CPU kernels
+    :return: model
+    """
+    compiled = (Encoder, Decoder, MlpBlock, DDC, WeightedMean)
+
+    def visit(module):
+        if isinstance(module, compiled):
+            if hasattr(module, 'compile'):
+                module.compile(mode=mode, backend=backend)
+            else:
+                # nn.Module.compile is only available from torch 2.2 on
+                module.forward = torch.compile(module.forward, mode=mode, backend=backend)
+            return
+        for child in module.children():
+            visit(child)
+
+    visit(model)
+    return model
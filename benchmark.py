@@ -0,0 +1,473 @@
+"""
+Benchmarks for the SDCC hot paths on synthetic data.
+
+    python benchmark.py solvers --dims 20 30 25 40 35 --dim 20 --n_iter 10
+    python benchmark.py whitening --dims 20 30 25 40 35 --ns_iters 10 20 30
+    python benchmark.py compile --n 2000 --compile_modes default max-autotune
+    python benchmark.py suite --n 2000 --save_baseline baseline.json
+    python benchmark.py suite --n 2000 --baseline baseline.json --out results.json
+"""
+import argparse
+import copy
+import ctypes
+import json
+import platform
+import sys
+import time
+import numpy as np
+import torch
+from objectives import dcp_loss, mdcp_loss, safe_loss, whitening
+from kernel import median_bandwidth, vector_kernel
+from SDCC_model import DCP, DDC, WeightedMean, compile_model
+from utils import cluster_eval
+
+
+def synthetic_embeddings(dims, m, device, seed=0):
+    """
+    Random view embeddings shaped like the encoder outputs fed to the DCC solver.
+
+    :param dims: Number of features of every view
+    :param m: Embedding size (`out_dim` of the encoder)
+    :return: List of (d_i, m) tensors
+    """
+    g = torch.Generator().manual_seed(seed)
+    return [torch.randn(d, m, generator=g).to(device).requires_grad_() for d in dims]
+
+
+def timeit(fn, repeat=5, device=torch.device('cpu')):
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    ts = time.time()
+    for _ in range(repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, (time.time() - ts) / repeat
+
+
+def covariation(X, W, k):
+    """
+    Objective maximised by the multi-view DCC solvers, sum_ij tr(Wi^T Xi Xj^T Wj), over the leading
+    `k` components. A has rank <= m, so only the leading m components carry signal.
+    """
+    with torch.no_grad():
+        P = sum(torch.matmul(X[i].t().double(), torch.from_numpy(W[i][:, :k]).to(X[i].device).double())
+                for i in range(len(X)))
+        return torch.sum(P ** 2).item()
+
+
+def bench_solvers(args, device):
+    X = synthetic_embeddings(args.dims, args.m, device, args.seed)
+    dtype = torch.float64 if args.dcc_dtype == 64 else torch.float32
+    solver = mdcp_loss(args.dim, args.r, device, args.n_iter, dtype, tol=args.tol, whitening_method=args.whitening,
+                       numpy_export=True)
+
+    methods = [('pytorch', solver.loss), ('block', solver.loss_block), ('numpy', solver.loss_numpy_fast)]
+    results = []
+    for name, fn in methods:
+        (loss, W), t = timeit(lambda: fn(X), args.repeat, device)
+        results.append((name, loss.item(), W, t))
+
+    # Columns are only defined up to sign and the leading components may come out in a different
+    # order, so compare the leading subspaces per view through their principal angles
+    n_lead = min(args.m, args.dim)
+    W_ref = results[0][2]
+
+    print("views: {} - m: {} - dim: {} - n_iter: {} - tol: {} - whitening: {}".format(
+        args.dims, args.m, args.dim, args.n_iter, args.tol, args.whitening))
+    print("{:<10}{:>12}{:>16}{:>12}{:>12}{:>10}".format('solver', 'loss', 'covariation', 'min cos', 'time (ms)', 'speedup'))
+    for name, loss, W, t in results:
+        cos = []
+        for w_ref, w in zip(W_ref, W):
+            q_ref = np.linalg.qr(w_ref[:, :n_lead])[0]
+            q = np.linalg.qr(w[:, :n_lead])[0]
+            cos.append(np.linalg.svd(q_ref.T @ q, compute_uv=False).min())
+        print("{:<10}{:>12.4f}{:>16.4f}{:>12.6f}{:>12.2f}{:>9.2f}x".format(
+            name, loss, covariation(X, W, n_lead), min(cos), t * 1000, results[0][3] / t))
+
+
+def bench_whitening(args, device):
+    """
+    Time and accuracy of the whitening methods. The residual ||Z Sii Z - I||_F / sqrt(d) of the
+    returned Z = Sii^-1/2, worst view, shows how far a Newton-Schulz run is from converged.
+    """
+    dtype = torch.float64 if args.dcc_dtype == 64 else torch.float32
+    X = [x.detach().to(dtype) for x in synthetic_embeddings(args.dims, args.m, device, args.seed)]
+    methods = [('eigh', 'eigh', None), ('lowrank', 'lowrank', None)]
+    methods += [('ns_{}'.format(n), 'newton_schulz', n) for n in args.ns_iters]
+
+    print("views: {} - m: {} - r: {} - dtype: {}".format(args.dims, args.m, args.r, dtype))
+    print("{:<12}{:>14}{:>12}".format('method', 'residual', 'time (ms)'))
+    for name, method, ns_iter in methods:
+        w = whitening(args.r, 1e-6, method, ns_iter or 30)
+        Z, t = timeit(lambda: [w.root_inv(i, x) for i, x in enumerate(X)], args.repeat, device)
+        residual = 0.
+        for x, z in zip(X, Z):
+            d = x.shape[0]
+            eye = torch.eye(d, device=device, dtype=dtype)
+            S = torch.matmul(x, x.t()) + args.r * eye
+            residual = max(residual, (torch.linalg.norm(z @ S @ z - eye) / d ** 0.5).item())
+        print("{:<12}{:>14.3e}{:>12.3f}".format(name, residual, t * 1000))
+
+
+def synthetic_clusters(n, n_features, n_clusters, device, seed=0):
+    """
+    Hidden representation and soft assignments shaped like the DDC outputs.
+    """
+    g = torch.Generator().manual_seed(seed)
+    lbl = torch.randint(0, n_clusters, (n,), generator=g)
+    centers = 2 * torch.randn(n_clusters, n_features, generator=g)
+    hidden = centers[lbl] + torch.randn(n, n_features, generator=g)
+    logits = torch.randn(n, n_clusters, generator=g) + 3 * torch.nn.functional.one_hot(lbl, n_clusters)
+    return hidden.to(device), torch.softmax(logits, dim=1).to(device)
+
+
+def bench_bandwidth(args, device):
+    """
+    Loss of every bandwidth mode against the exact median over a run of epochs in which the hidden
+    representation drifts.
+    """
+    hidden, output = synthetic_clusters(args.n, args.n_features, args.n_clusters, device, args.seed)
+    drift = torch.randn(hidden.shape, generator=torch.Generator().manual_seed(args.seed + 1)).to(device)
+    exact = safe_loss(args.n_clusters, device)
+
+    print("n: {} - epochs: {} - n_pairs: {} - momentum: {} - warmup: {}".format(
+        args.n, args.epochs, args.n_pairs, args.momentum, args.warmup))
+    print("{:<10}{:>18}{:>18}{:>12}".format('mode', 'mean |dloss|/loss', 'max |dloss|/loss', 'time (ms)'))
+    for mode in ['exact', 'sampled', 'ema', 'frozen']:
+        bandwidth = median_bandwidth(mode, n_pairs=args.n_pairs, momentum=args.momentum, warmup=args.warmup)
+        estimate = safe_loss(args.n_clusters, device, bandwidth=bandwidth)
+        err = []
+        t = 0
+        for epoch in range(args.epochs):
+            h = hidden + 0.05 * epoch * drift
+            with torch.no_grad():
+                ref = exact.forward_cluster(h, output)[0].item()
+                ts = time.time()
+                loss = estimate.forward_cluster(h, output)[0].item()
+                t += time.time() - ts
+            bandwidth.epoch()
+            err.append(abs(loss - ref) / abs(ref))
+        print("{:<10}{:>18.2e}{:>18.2e}{:>12.2f}".format(mode, np.mean(err), np.max(err), t / args.epochs * 1000))
+
+def synthetic_views(n, dims, n_clusters, device, seed=0):
+    """
+    Multi-view data with a shared cluster structure, transposed to the (d_v, N) layout fed to DCP.
+    """
+    g = torch.Generator().manual_seed(seed)
+    lbl = torch.randint(0, n_clusters, (n,), generator=g)
+    xt = []
+    for d in dims:
+        centers = 3 * torch.randn(n_clusters, d, generator=g)
+        xt.append((centers[lbl] + torch.randn(n, d, generator=g)).t().contiguous().to(device))
+    return xt
+
+
+def sdcc_step(args, device, compile_mode=None):
+    """
+    One first phase training step (both DCP models, gate, DDC and the combined loss) as a closure.
+    `step.reset()` puts the models and the optimizer back into their initial state, so that repeated
+    measurements all time the same step.
+    """
+    torch.manual_seed(args.seed)
+    xt = synthetic_views(args.n, args.dims, args.n_clusters, device, args.seed)
+    n_view = len(args.dims)
+    dim = min(args.dim, min(args.dims))
+    dtype = torch.float64 if args.dcc_dtype == 64 else torch.float32
+    kw = dict(n_iter=args.n_iter, dcc_dtype=dtype, dcc_tol=args.tol, whitening_method=args.whitening)
+    old = DCP(args.n, args.n_features, args.m, n_view - 1, dim, args.r, device, **kw).to(device)
+    new = DCP(args.n, args.n_features, args.m, n_view, dim, args.r, device, **kw).to(device)
+    gate = WeightedMean(2).to(device)
+    ddc = DDC(dim, args.n_clusters).to(device)
+    cluster_loss = safe_loss(args.n_clusters, device)
+    if compile_mode is not None:
+        for model in (old, new, gate, ddc):
+            compile_model(model, mode=compile_mode, backend=args.compile_backend)
+    params = [p for model in (old, new, gate, ddc) for p in model.parameters()]
+    optimizer = torch.optim.Adam(params, lr=1e-4)
+    initial = copy.deepcopy(([model.state_dict() for model in (old, new, gate, ddc)], optimizer.state_dict()))
+
+    def reset():
+        models, opt = initial
+        for model, state in zip((old, new, gate, ddc), models):
+            model.load_state_dict(state)
+        optimizer.load_state_dict(opt)
+
+    def step():
+        optimizer.zero_grad()
+        (_, fused_old, dcp_old, dec_old), (_, fused_new, dcp_new, dec_new) = old(xt), new(xt)
+        output, hidden = ddc(gate([fused_old, fused_new]))
+        loss = 0.1 * (dcp_old + dcp_new) + 0.01 * (dec_old + dec_new) + 0.01 * cluster_loss.forward_cluster(hidden, output)[0]
+        loss.backward()
+        optimizer.step()
+        return loss.detach()
+    step.reset = reset
+    return step
+
+
+def bench_compile(args, device):
+    """
+    Per-epoch time of the first phase step, eager against compiled. The first calls of the compiled
+    step trigger (re)compilation and are reported separately.
+    """
+    print("n: {} - views: {} - hidden: {} - backend: {}".format(args.n, args.dims, args.n_features, args.compile_backend))
+    print("{:<18}{:>14}{:>14}{:>16}{:>10}".format('mode', 'warmup (s)', 'epoch (ms)', 'loss', 'speedup'))
+    ref = None
+    for mode in [None] + args.compile_modes:
+        step = sdcc_step(args, device, mode)
+        ts = time.time()
+        for _ in range(args.warmup_steps):
+            step()
+        warmup = time.time() - ts
+        loss, t = timeit(step, args.repeat, device)
+        ref = ref or t
+        print("{:<18}{:>14.2f}{:>14.2f}{:>16.6f}{:>9.2f}x".format(str(mode or 'eager'), warmup, t * 1000, loss.item(), ref / t))
+
+
+def _rss():
+    """
+    Current and peak resident set size in bytes, None off Linux.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+    except OSError:
+        return None
+    return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+
+
+def _reset_peak_rss():
+    # Return freed heap memory first, which would otherwise be reused without showing up in the peak
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory(fn, device):
+    """
+    Memory a call of `fn` takes on top of what is allocated before it, in bytes: the peak of the
+    CUDA caching allocator on CUDA, the peak RSS of the process on the host. None if it cannot be
+    measured (host peaks need Linux).
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - before
+    if _rss() is None or not _reset_peak_rss():
+        return None
+    before = _rss()[0]
+    fn()
+    return max(_rss()[1] - before, 0)
+
+
+def measure(fn, repeat, device, warmup=1, reset=None):
+    """
+    Median and minimum time of single calls of `fn` in ms, after `warmup` calls, and its peak memory
+    in MB.
+
+    :param reset: Called untimed before every call of `fn`, e.g. to undo the updates of a training step
+    """
+    reset = reset or (lambda: None)
+    for _ in range(warmup):
+        reset()
+        fn()
+    times = []
+    for _ in range(repeat):
+        reset()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        ts = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append((time.perf_counter() - ts) * 1000)
+    reset()
+    peak = peak_memory(fn, device)
+    return dict(median_ms=float(np.median(times)), min_ms=float(np.min(times)),
+                peak_mb=peak / 2**20 if peak is not None else None)
+
+
+SUITE_CASES = ('mdcp_loss', 'dcp_loss', 'safe_loss', 'safe_loss_grad', 'vector_kernel', 'dcp_forward', 'cluster_eval',
+               'end_to_end')
+
+
+def suite_cases(args, device):
+    """
+    Closures of the benchmarked hot paths (SUITE_CASES), each on fixed synthetic data. Closures with a
+    `reset` attribute are reset before every measured call.
+    """
+    dtype = torch.float64 if args.dcc_dtype == 64 else torch.float32
+    X = synthetic_embeddings(args.dims, args.m, device, args.seed)
+    dim = min(args.dim, min(args.dims))
+    mdcp = mdcp_loss(dim, args.r, device, args.n_iter, dtype, tol=args.tol, whitening_method=args.whitening)
+    dcp = dcp_loss(min(dim, args.m), args.r, device, dtype, args.whitening)
+    hidden, output = synthetic_clusters(args.n, args.n_features, args.n_clusters, device, args.seed)
+    hidden_grad = hidden.clone().requires_grad_()
+    cluster_loss = safe_loss(args.n_clusters, device)
+
+    torch.manual_seed(args.seed)
+    xt = synthetic_views(args.n, args.dims, args.n_clusters, device, args.seed)
+    model = DCP(args.n, args.n_features, args.m, len(args.dims), dim, args.r, device, n_iter=args.n_iter, dcc_dtype=dtype,
+                dcc_tol=args.tol, whitening_method=args.whitening).to(device)
+    lbl = torch.randint(0, args.n_clusters, (args.n,), generator=torch.Generator().manual_seed(args.seed)).numpy()
+    pred = output.argmax(dim=1).cpu().numpy()
+
+    def safe_loss_grad():
+        hidden_grad.grad = None
+        cluster_loss.forward_cluster(hidden_grad, output)[0].backward()
+
+    def dcp_forward():
+        with torch.no_grad():
+            return model(xt)
+
+    return dict(
+        mdcp_loss=lambda: mdcp.loss(X),
+        dcp_loss=lambda: dcp.loss(X[:2]),
+        safe_loss=lambda: cluster_loss.forward_cluster(hidden, output),
+        safe_loss_grad=safe_loss_grad,
+        vector_kernel=lambda: vector_kernel(hidden),
+        dcp_forward=dcp_forward,
+        cluster_eval=lambda: cluster_eval(y_true=lbl, y_pred=pred),
+        end_to_end=sdcc_step(args, device),
+    )
+
+
+def environment(args, device):
+    return dict(python=platform.python_version(), torch=torch.__version__, platform=platform.platform(),
+                device=str(device) if device.type != 'cuda' else torch.cuda.get_device_name(device),
+                threads=torch.get_num_threads(),
+                params=dict(n=args.n, dims=args.dims, m=args.m, dim=args.dim, n_iter=args.n_iter, dcc_dtype=args.dcc_dtype,
+                            whitening=args.whitening, n_features=args.n_features, n_clusters=args.n_clusters,
+                            seed=args.seed))
+
+
+def compare(results, baseline):
+    """
+    Cases that got slower or use more memory than the baseline allows.
+
+    :return: List of (case, metric, value, baseline value, limit)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['cases']:
+            continue
+        ref = baseline['cases'][name]
+        thresholds = ref.get('thresholds', baseline['thresholds'])
+        # The fastest call is the least affected by other load on the machine
+        limit = ref['min_ms'] * (1 + thresholds['time']) + thresholds['time_slack_ms']
+        if result['min_ms'] > limit:
+            regressions.append((name, 'min_ms', result['min_ms'], ref['min_ms'], limit))
+        if result['peak_mb'] is not None and ref['peak_mb'] is not None:
+            # Small absolute slack, peaks of a few MB are within page and allocator granularity
+            limit = ref['peak_mb'] * (1 + thresholds['memory']) + thresholds['memory_slack_mb']
+            if result['peak_mb'] > limit:
+                regressions.append((name, 'peak_mb', result['peak_mb'], ref['peak_mb'], limit))
+    return regressions
+
+
+def bench_suite(args, device):
+    """
+    Time and peak memory of every hot path, written as JSON, optionally saved as a baseline with
+    regression thresholds or checked against one. Exits with status 1 on a regression.
+    """
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    env = environment(args, device)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key in ('torch', 'device', 'threads', 'params'):
+            if baseline['environment'][key] != env[key]:
+                print("warning: baseline {} {} differs from {}".format(key, baseline['environment'][key], env[key]))
+
+    cases = suite_cases(args, device)
+    names = args.cases or list(cases)
+    print("n: {} - views: {} - m: {} - dim: {} - device: {} - threads: {}".format(
+        args.n, args.dims, args.m, args.dim, env['device'], env['threads']))
+    print("{:<16}{:>14}{:>12}{:>12}{:>14}".format('case', 'median (ms)', 'min (ms)', 'peak (MB)', 'vs baseline'))
+    results = {}
+    for name in names:
+        result = measure(cases[name], args.repeat, device, args.warmup_steps, getattr(cases[name], 'reset', None))
+        results[name] = result
+        ratio = ''
+        if baseline is not None and name in baseline['cases']:
+            ratio = '{:.2f}x'.format(result['min_ms'] / baseline['cases'][name]['min_ms'])
+        peak = '{:.1f}'.format(result['peak_mb']) if result['peak_mb'] is not None else '-'
+        print("{:<16}{:>14.2f}{:>12.2f}{:>12}{:>14}".format(name, result['median_ms'], result['min_ms'], peak, ratio))
+
+    thresholds = dict(time=args.time_tolerance, time_slack_ms=args.time_slack, memory=args.memory_tolerance,
+                      memory_slack_mb=args.memory_slack)
+    report = dict(environment=env, thresholds=thresholds, cases=results)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    if baseline is not None:
+        regressions = compare(results, baseline)
+        for name, metric, value, ref, limit in regressions:
+            print("REGRESSION {} {}: {:.2f} (baseline {:.2f}, limit {:.2f})".format(name, metric, value, ref, limit))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', choices=['solvers', 'whitening', 'bandwidth', 'compile', 'suite'])
+    parser.add_argument('--dims', type=int, nargs='+', default=[20, 30, 25, 40, 35])
+    parser.add_argument('--m', type=int, default=2)
+    parser.add_argument('--dim', type=int, default=20)
+    parser.add_argument('--r', type=float, default=1e-1)
+    parser.add_argument('--n_iter', type=int, default=10)
+    parser.add_argument('--tol', type=float, default=None)
+    parser.add_argument('--dcc_dtype', type=int, default=64)
+    parser.add_argument('--whitening', choices=['eigh', 'lowrank', 'newton_schulz'], default='eigh')
+    parser.add_argument('--ns_iters', type=int, nargs='+', default=[10, 20, 30])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n', type=int, default=2000)
+    parser.add_argument('--n_features', type=int, default=512)
+    parser.add_argument('--n_clusters', type=int, default=7)
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--n_pairs', type=int, default=100000)
+    parser.add_argument('--momentum', type=float, default=0.9)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--compile_modes', nargs='+', default=['default'])
+    parser.add_argument('--compile_backend', default='inductor')
+    parser.add_argument('--warmup_steps', type=int, default=3)
+    parser.add_argument('--cases', nargs='+', choices=SUITE_CASES, default=None, help='suite cases to run, all by default')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads, fix for comparable results')
+    parser.add_argument('--out', default=None, help='JSON file for the suite results')
+    parser.add_argument('--baseline', default=None, help='suite baseline to check for regressions')
+    parser.add_argument('--save_baseline', default=None, help='save the suite results as a baseline')
+    parser.add_argument('--time_tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    parser.add_argument('--time_slack', type=float, default=0.5, help='allowed absolute slowdown in ms')
+    parser.add_argument('--memory_tolerance', type=float, default=0.1, help='allowed relative peak memory growth')
+    parser.add_argument('--memory_slack', type=float, default=4., help='allowed absolute peak memory growth in MB')
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.bench == 'solvers':
+        bench_solvers(args, device)
+    elif args.bench == 'whitening':
+        bench_whitening(args, device)
+    elif args.bench == 'bandwidth':
+        bench_bandwidth(args, device)
+    elif args.bench == 'compile':
+        bench_compile(args, device)
+    elif args.bench == 'suite':
+        bench_suite(args, device)
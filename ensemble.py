@@ -0,0 +1,305 @@
+import copy
+import logging
+import math
+import time
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+from objectives import safe_loss
+from precision import PrecisionPolicy
+from utils import cluster_eval
+
+
+class Stacked():
+    """
+    Parameters and buffers of K modules of identical structure, stacked along a leading member
+    dimension. `call` runs one member functionally and is meant to be vmapped over that dimension.
+    """
+    def __init__(self, modules):
+        self.params, self.buffers = stack_module_state(modules)
+        self.base = copy.deepcopy(modules[0]).to('meta')
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def train(self, mode=True):
+        self.base.train(mode)
+
+    def eval(self):
+        self.base.train(False)
+
+    def call(self, params, buffers, *args):
+        return functional_call(self.base, (params, buffers), args)
+
+
+class EnsembleSolver():
+    """
+    Solver for K independently initialised SDCC models, e.g. one per seed, trained in lockstep.
+
+    The Encoder/Decoder, fusion, gate and DDC modules of all members are stacked and run as one
+    batched forward and backward pass through vmap. Every member only sees its own parameters,
+    optimizer state (Adam is elementwise) and loss, so each follows the trajectory of its
+    sequential Solver run up to the summation order of the batched kernels. The covariation solves
+    and the clustering losses have data dependent shapes and custom autograd functions and run per
+    member on the stacked outputs.
+
+    Only the full batch, two model (old/new DCP) setup with the exact clustering kernel and median
+    bandwidth is supported, so `batch_shuffle` has no effect. Epochs are evaluated synchronously.
+    Options that draw from the global RNG (anchors, sampled bandwidths, Nystrom and random Fourier
+    kernels) would interleave the draws of the members and are rejected.
+
+    Known divergence: with cca_dim > out_dim, the covariation components after the first out_dim
+    only hold rounding noise (A has rank <= out_dim), which the batched kernels round differently.
+    The members then drift away from their sequential runs and only agree with them in
+    distribution. With cca_dim <= out_dim they follow the sequential runs.
+
+    :param members: (old_model, new_model, gate, ddc_model) of every member
+    :param bandwidth: Bandwidth estimator of every member, or None for the exact median
+    """
+    def __init__(self, members, lmbda, lmbda2, lmbda3, dim, n_class, epoch_num, batch_size, learning_rate, reg_par, r,
+                 device=torch.device('cpu'), batch_shuffle=True, n_anchors=0, cluster_kernel='exact', kernel_rank=256,
+                 bandwidth=None, eval_every=1, async_eval=False, feature_dtype=None, finetune_compile=None,
+                 precision=None, finetune_lr=None):
+        if batch_size is not None:
+            raise ValueError("EnsembleSolver only trains on the full batch")
+        if any(new_model is None for _, new_model, _, _ in members):
+            raise ValueError("EnsembleSolver needs separate old and new DCP models")
+        if finetune_compile is not None:
+            raise ValueError("EnsembleSolver does not support finetune_compile")
+        if async_eval:
+            raise ValueError("EnsembleSolver evaluates synchronously, async_eval must be False")
+        if n_anchors != 0:
+            raise ValueError("EnsembleSolver does not support anchors")
+        if cluster_kernel != 'exact':
+            raise ValueError("EnsembleSolver only supports the exact clustering kernel")
+        self.n_member = len(members)
+        if bandwidth is None:
+            bandwidth = [None] * self.n_member
+        if any(b is not None and b.mode != 'exact' for b in bandwidth):
+            raise ValueError("EnsembleSolver only supports the exact median bandwidth")
+        self.old_models = [m[0].to(device) for m in members]
+        self.new_models = [m[1].to(device) for m in members]
+        self.old_enc = Stacked([m.Enc for m in self.old_models])
+        self.old_dec = Stacked([m.Dec for m in self.old_models])
+        self.old_fusion = Stacked([m.fusion for m in self.old_models])
+        self.new_enc = Stacked([m.Enc for m in self.new_models])
+        self.new_dec = Stacked([m.Dec for m in self.new_models])
+        self.new_fusion = Stacked([m.fusion for m in self.new_models])
+        self.gate = Stacked([m[2].to(device) for m in members])
+        self.ddc_model = Stacked([m[3].to(device) for m in members])
+        self.dcp_modules = [self.old_enc, self.old_dec, self.old_fusion, self.new_enc, self.new_dec, self.new_fusion]
+
+        self.epoch_num = epoch_num
+        self.lmbda = lmbda
+        self.lmbda2 = lmbda2
+        self.lmbda3 = lmbda3
+        self.n_class = n_class
+        self.cluster_loss = [safe_loss(n_class, device, cluster_kernel, kernel_rank, b) for b in bandwidth]
+        self.precision = precision if precision is not None else PrecisionPolicy(device)
+        self.sdcp_optimizer = self.precision.adam([p for m in self.dcp_modules for p in m.parameters()]
+                                                  + self.gate.parameters() + self.ddc_model.parameters(),
+                                                  lr=learning_rate, weight_decay=reg_par)
+        finetune_lr = finetune_lr if finetune_lr is not None else learning_rate
+        self.finetune_optimizer = self.precision.adam(self.gate.parameters() + self.ddc_model.parameters(),
+                                                      lr=finetune_lr, weight_decay=reg_par)
+        self.finetune_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(self.finetune_optimizer, T_max=150,
+                                                                             eta_min=finetune_lr/10)
+        self.device = device
+        self.eval_every = eval_every
+        self.feature_dtype = feature_dtype
+        self.grad_scaler = self.precision.grad_scaler()
+
+        logging.basicConfig(
+            level=logging.DEBUG, format="[ %(levelname)s : %(asctime)s ] - %(message)s")
+        self.logger = logging.getLogger("Pytorch")
+
+    def encode(self, dcp, enc, dec, xt):
+        """
+        Encoder outputs of the first `dcp.view` views and decoder losses of all members, as DCP.encode.
+        """
+        n_view = dcp.view
+
+        def member(p_enc, b_enc, p_dec, b_dec):
+            if dcp.packed:
+                sizes = [xt[v].shape[0] for v in range(n_view)]
+                with self.precision.mlp():
+                    eot, eoh = enc.call(p_enc, b_enc, torch.cat(xt[:n_view], dim=0))
+                    dot, doh = dec.call(p_dec, b_dec, eot)
+                eot, eoh, dot, doh = self.precision.output(eot, eoh, dot, doh)
+                eo = list(torch.split(eot, sizes))
+                eh, do, dh = torch.split(eoh, sizes), torch.split(dot, sizes), torch.split(doh, sizes)
+                return eo, sum([dcp.dec_loss(xt[v], eh[v], do[v], dh[v]) for v in range(n_view)])
+            eo = []
+            dec_loss = []
+            for v in range(n_view):
+                with self.precision.mlp():
+                    eot, eoh = enc.call(p_enc, b_enc, xt[v])
+                    dot, doh = dec.call(p_dec, b_dec, eot)
+                eot, eoh, dot, doh = self.precision.output(eot, eoh, dot, doh)
+                eo.append(eot)
+                dec_loss.append(dcp.dec_loss(xt[v], eoh, dot, doh))
+            return eo, sum(dec_loss)
+
+        return vmap(member)(enc.params, enc.buffers, dec.params, dec.buffers)
+
+    def solve(self, models, eo):
+        """
+        Covariation solve of every member on its slice of the stacked encoder outputs. Members that
+        diverged keep their last projections.
+        """
+        losses = []
+        W = []
+        for k, model in enumerate(models):
+            if self.active[k] or model not in self.last_W:
+                loss, Wk = model.dcp_loss([e[k] for e in eo])
+                self.last_W[model] = Wk
+            else:
+                loss, Wk = eo[0].new_zeros(()), self.last_W[model]
+            losses.append(loss)
+            W.append(Wk)
+        return torch.stack(losses), [torch.stack([Wk[v] for Wk in W]) for v in range(len(eo))]
+
+    def fuse(self, fusion, W, xt):
+        def member(p, b, *W):
+            c_list = [torch.matmul(W[v].t(), xt[v]) for v in range(len(W))]
+            return fusion.call(p, b, torch.cat(c_list, dim=0).t())
+        return vmap(member)(fusion.params, fusion.buffers, *W)
+
+    def dcp_forward(self, xt):
+        """
+        (fused, dcp_loss, dec_loss) of the old and the new DCP models, each stacked over the members.
+        """
+        out = []
+        for models, enc, dec, fusion in ((self.old_models, self.old_enc, self.old_dec, self.old_fusion),
+                                         (self.new_models, self.new_enc, self.new_dec, self.new_fusion)):
+            eo, dec_loss = self.encode(models[0], enc, dec, xt)
+            dcp_loss, W = self.solve(models, eo)
+            out.append((self.fuse(fusion, W, xt), dcp_loss, dec_loss))
+        return out
+
+    def ddc_forward(self, fused_old, fused_new):
+        def member(p_g, b_g, p_d, b_d, fused_old, fused_new):
+            fused = self.gate.call(p_g, b_g, [fused_old, fused_new])
+            with self.precision.mlp():
+                output, hidden = self.ddc_model.call(p_d, b_d, fused)
+            return self.precision.output(output, hidden)
+        return vmap(member)(self.gate.params, self.gate.buffers, self.ddc_model.params, self.ddc_model.buffers,
+                            fused_old, fused_new)
+
+    def cluster_losses(self, hidden, output):
+        return torch.stack([self.cluster_loss[k].forward_cluster(hidden[k], output[k])[0]
+                            for k in range(self.n_member)])
+
+    def step(self, optimizer, loss):
+        """
+        One optimizer step on the summed losses of the members that are still training. A diverged
+        member gets no gradient; its parameters are no longer evaluated.
+        """
+        active = torch.tensor(self.active, device=loss.device)
+        self.grad_scaler.scale(loss[active].sum()).backward()
+        self.grad_scaler.step(optimizer)
+        self.grad_scaler.update()
+
+    def end_epoch(self):
+        for cluster_loss in self.cluster_loss:
+            if cluster_loss.bandwidth is not None:
+                cluster_loss.bandwidth.epoch()
+
+    def check(self, loss):
+        """
+        Stop the members whose loss is NaN, as Solver.fit returns at the first NaN loss.
+        """
+        loss = loss.detach().cpu().numpy()
+        for k in range(self.n_member):
+            if self.active[k] and math.isnan(loss[k]):
+                self.active[k] = False
+        return loss
+
+    def fit(self, x, lbl, times=0):
+        """
+        :return: (nmi, acc, pur, ep) of every member
+        """
+        n_view = len(x)
+        xt = [x[v].to(self.device).t() for v in range(n_view)]
+
+        self.nmi = [0] * self.n_member
+        self.acc = [0] * self.n_member
+        self.pur = [0] * self.n_member
+        self.ep = [self.epoch_num] * self.n_member
+        self.active = [True] * self.n_member
+        self.last_W = {}
+
+        def results():
+            return list(zip(self.nmi, self.acc, self.pur, self.ep))
+
+        for epoch in range(self.epoch_num):
+            epoch_start_time = time.time()
+
+            for m in self.dcp_modules + [self.gate, self.ddc_model]:
+                m.train()
+            self.sdcp_optimizer.zero_grad()
+
+            (fused_old, dcp_loss_old, dec_loss_old), (fused_new, dcp_loss_new, dec_loss_new) = self.dcp_forward(xt)
+            dcp_loss = dcp_loss_old + dcp_loss_new
+            dec_loss = dec_loss_old + dec_loss_new
+
+            output, hidden = self.ddc_forward(fused_old, fused_new)
+
+            safe_loss = self.cluster_losses(hidden, output)
+            loss = self.lmbda * dcp_loss + self.lmbda2 * dec_loss + self.lmbda3 * safe_loss
+
+            train_loss = self.check(loss)
+            if not any(self.active):
+                return results()
+            self.step(self.sdcp_optimizer, loss)
+            self.end_epoch()
+
+            info_string = "{:d} Epoch {:d}/{:d} - time: {:.2f} - training_loss: {}"
+            self.logger.info(info_string.format(times, epoch + 1, self.epoch_num, time.time() - epoch_start_time,
+                                                np.array2string(train_loss, precision=4)))
+
+        for m in self.dcp_modules:
+            m.eval()
+        with torch.no_grad():
+            (fused_old, _, _), (fused_new, _, _) = self.dcp_forward(xt)
+            features = torch.stack([fused_old, fused_new], dim=1)
+        if self.feature_dtype is not None:
+            features = features.to(self.feature_dtype)
+        features = features.contiguous()
+        dtype = self.gate.params['weights'].dtype
+
+        for epoch in range(150):
+            epoch_start_time = time.time()
+
+            self.gate.train()
+            self.ddc_model.train()
+            self.finetune_optimizer.zero_grad()
+
+            output, hidden = self.ddc_forward(features[:, 0].to(dtype), features[:, 1].to(dtype))
+            loss = self.cluster_losses(hidden, output)
+
+            train_loss = self.check(loss)
+            if not any(self.active):
+                return results()
+            self.step(self.finetune_optimizer, loss)
+            self.finetune_scheduler.step()
+            self.end_epoch()
+
+            if (epoch + 1) % self.eval_every == 0 or epoch + 1 == 150:
+                clbl = torch.argmax(output.detach(), dim=2).cpu().numpy()
+                for k in range(self.n_member):
+                    if not self.active[k]:
+                        continue
+                    nmi_score, pur_score, acc_score = cluster_eval(y_true=lbl, y_pred=clbl[k])
+                    if self.nmi[k] < nmi_score:
+                        self.nmi[k] = nmi_score
+                        self.acc[k] = acc_score
+                        self.pur[k] = pur_score
+                        self.ep[k] = epoch + 1
+
+            info_string = "{:d} Epoch {:d}/{:d} - lr: {:.5f} - time: {:.2f} - training_loss: {}"
+            self.logger.info(info_string.format(times, epoch + 1, 150, self.finetune_optimizer.param_groups[0]['lr'],
+                                                time.time() - epoch_start_time,
+                                                np.array2string(train_loss, precision=4)))
+
+        return results()
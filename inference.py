@@ -0,0 +1,166 @@
+"""
+Cluster assignment of new samples with a trained SDCC model.
+
+    python inference.py model.pt Caltech-5v --batch_size 65536 --device cuda --out labels.npy
+
+Models are exported by main.py (config `export`) or Solver.export().save(path), as they are after the
+last fine-tune epoch.
+"""
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from SDCC_model import DDC, WeightedMean
+
+
+class Predictor(nn.Module):
+    """
+    Trained SDCC model for out-of-sample inference.
+
+    The encoders of a DCP model act on the features and only yield the covariation projections W,
+    which map the (n, d_v) views into the shared space and do not depend on the training samples. A
+    new sample is projected by the W of the old and the new DCP model, passed through their fusion
+    layers, the gate and DDC, so samples are scored independently and in batches of any size. DDC
+    runs in eval mode, with the BatchNorm statistics collected during training.
+
+    :param dims: Features of every view
+    :param views: Views of every DCP model, e.g. [n_view - 1, n_view]
+    """
+    def __init__(self, dims, views, cca_dim, n_class, n_features=512):
+        super().__init__()
+        self.spec = dict(dims=list(dims), views=list(views), cca_dim=cca_dim, n_class=n_class, n_features=n_features)
+        self.W = nn.ModuleList([
+            nn.ParameterList([nn.Parameter(torch.zeros(d, cca_dim), requires_grad=False) for d in dims[:view]])
+            for view in views
+        ])
+        self.fusion = nn.ModuleList([nn.Sequential(nn.Linear(cca_dim*view, cca_dim, bias=True)) for view in views])
+        self.gate = WeightedMean(len(views))
+        self.ddc_model = DDC(cca_dim, n_class, n_features)
+        self.staging = {}
+        self.eval()
+
+    @classmethod
+    def from_modules(cls, W, fusion, gate, ddc_model):
+        """
+        Copy of trained modules, which are left as they are.
+
+        :param W: Projections of every DCP model, each a list of (d_v, cca_dim) matrices
+        :param fusion: Fusion layer of every DCP model
+        """
+        linear = ddc_model.output[0]
+        predictor = cls([w.shape[0] for w in max(W, key=len)], [len(Wh) for Wh in W], W[0][0].shape[1],
+                         linear.out_features, linear.in_features)
+        with torch.no_grad():
+            for params, Wh in zip(predictor.W, W):
+                for p, w in zip(params, Wh):
+                    p.copy_(w)
+        for dst, src in zip(predictor.fusion, fusion):
+            dst.load_state_dict(src.state_dict())
+        predictor.gate.load_state_dict(gate.state_dict())
+        predictor.ddc_model.load_state_dict(ddc_model.state_dict())
+        return predictor.to(linear.weight.device)
+
+    def save(self, path):
+        torch.save(dict(spec=self.spec, state=self.state_dict()), path)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        saved = torch.load(path, map_location=device, weights_only=True)
+        predictor = cls(**saved['spec'])
+        predictor.load_state_dict(saved['state'])
+        return predictor.to(device)
+
+    def forward(self, x):
+        """
+        :param x: Views of a batch of samples, (n, d_v) each
+        :return: Cluster probabilities (n, n_class) and DDC hidden features
+        """
+        fused = [fusion(torch.cat([x[v] @ W[v] for v in range(len(W))], dim=1)) for fusion, W in zip(self.fusion, self.W)]
+        return self.ddc_model(self.gate(fused))
+
+    def to_device(self, x, slot):
+        """
+        float32 device copy of a view batch. Host arrays are copied once, into one of two alternating
+        pinned buffers per view on CUDA, so the transfer of a batch overlaps scoring the previous one.
+        """
+        device = self.ddc_model.output[0].weight.device
+        if torch.is_tensor(x):
+            return x.to(device, torch.float32, non_blocking=True)
+        cuda = device.type == 'cuda'
+        buf = self.staging.get(slot)
+        if buf is None or buf.shape != x.shape:
+            buf = torch.empty(x.shape, dtype=torch.float32, pin_memory=cuda)
+            self.staging[slot] = buf
+        buf.numpy()[...] = x
+        return buf.to(device, non_blocking=cuda)
+
+    def score(self, batches):
+        """
+        Cluster probabilities of a stream of batches, e.g. requests of a scoring service. The result of
+        a batch is only waited for once the next batch is queued.
+
+        :param batches: Iterable of view lists, (n, d_v) arrays or tensors each
+        :return: Generator of (n, n_class) numpy arrays
+        """
+        dims = self.spec['dims']
+        pending = None
+        for i, x in enumerate(batches):
+            if len(x) < len(dims) or any(x[v].shape[1] != dims[v] for v in range(len(dims))):
+                raise ValueError("expected views with {} features, got {}".format(
+                    dims, [tuple(v.shape) for v in x]))
+            # Only around the batch, the generator must not leave inference mode on for the caller
+            with torch.inference_mode():
+                output = self([self.to_device(x[v], (i % 2, v)) for v in range(len(dims))])[0]
+                host = torch.empty(output.shape, dtype=output.dtype, pin_memory=output.is_cuda)
+                host.copy_(output, non_blocking=output.is_cuda)
+                event = None
+                if output.is_cuda:
+                    event = torch.cuda.Event()
+                    event.record()
+            if pending is not None:
+                yield self.ready(pending)
+            pending = (host, event)
+        if pending is not None:
+            yield self.ready(pending)
+
+    @staticmethod
+    def ready(pending):
+        host, event = pending
+        if event is not None:
+            event.synchronize()
+        return host.numpy()
+
+    def predict_proba(self, x, batch_size=65536):
+        """
+        :param x: Views of all samples, (N, d_v) arrays (also memory-mapped) or tensors
+        :return: (N, n_class) cluster probabilities
+        """
+        batches = ([v[start:start + batch_size] for v in x] for start in range(0, x[0].shape[0], batch_size))
+        return np.concatenate(list(self.score(batches)))
+
+    def predict(self, x, batch_size=65536):
+        """
+        :return: Cluster labels of all samples
+        """
+        return self.predict_proba(x, batch_size).argmax(axis=1)
+
+
+if __name__ == '__main__':
+    import sdcc_data
+    from utils import cluster_eval
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model')
+    parser.add_argument('dataset')
+    parser.add_argument('--batch_size', type=int, default=65536)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--out', default=None, help='.npy file for the predicted labels')
+    args = parser.parse_args()
+
+    predictor = Predictor.load(args.model, args.device)
+    X, lbl, _, _, _ = sdcc_data.load(args.dataset, len(predictor.spec['dims']))
+    pred = predictor.predict(X, args.batch_size)
+    nmi, pur, acc = cluster_eval(y_true=lbl, y_pred=pred)
+    print('NMI score: {:.2f}%, PUR score: {:.2f}%, ACC score: {:.2f}%'.format(nmi * 100, pur * 100, acc * 100))
+    if args.out is not None:
+        np.save(args.out, pred)
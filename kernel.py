@@ -1,12 +1,85 @@
+import math
 import torch as th
 import torch.nn
 from torch.nn.functional import relu
+from profiling import span
 EPSILON = 1E-9
 
 "Inspired by the implementation in https://github.com/DanielTrosten/mvc"
 
 
-def kernel_from_distance_matrix(dist, rel_sigma, min_sigma=EPSILON):
+class median_bandwidth():
+    """
+    Estimator of the Gaussian kernel bandwidth sigma^2 = rel_sigma * median(dist).
+
+    :param mode: 'exact' median over all distances.
+                 'sampled' median over `n_pairs` randomly drawn distances.
+                 'ema' sampled median smoothed across calls, m <- momentum * m + (1 - momentum) * m_new.
+                 'frozen' as 'ema' for the first `warmup` epochs, then kept fixed.
+    :type mode: str
+    :param n_pairs: Number of sampled distances
+    :type n_pairs: int
+    :param momentum: Weight of the running median
+    :type momentum: float
+    :param warmup: Number of epochs before the bandwidth is frozen. Epochs are counted by `epoch`,
+                   which the training loop calls once per epoch, so mini-batches do not shorten it
+    :type warmup: int
+    """
+    def __init__(self, mode='exact', n_pairs=100000, momentum=0.9, warmup=10):
+        if mode not in ('exact', 'sampled', 'ema', 'frozen'):
+            raise ValueError("unknown bandwidth mode: {}".format(mode))
+        self.mode = mode
+        self.n_pairs = n_pairs
+        self.momentum = momentum
+        self.warmup = warmup
+        self.median = None
+        self.calls = 0
+        self.epochs = 0
+
+    def __call__(self, dist, rel_sigma, min_sigma=EPSILON):
+        """
+        :param dist: Non-negative distance matrix
+        :type dist: th.Tensor
+        :return: sigma^2, without gradient
+        :rtype: th.Tensor
+        """
+        with th.no_grad():
+            if self.mode == 'frozen' and self.epochs >= self.warmup and self.median is not None:
+                median = self.median
+            elif self.mode == 'exact':
+                median = th.median(dist)
+            else:
+                median = self.sampled_median(dist)
+                if self.mode != 'sampled' and self.median is not None:
+                    median = self.momentum * self.median + (1 - self.momentum) * median
+            self.median = median
+            self.calls += 1
+        sigma2 = rel_sigma * median
+        return th.where(sigma2 < min_sigma, sigma2.new_tensor(min_sigma), sigma2)
+
+    def epoch(self):
+        """
+        End of a training epoch.
+        """
+        self.epochs += 1
+
+    def state_dict(self):
+        return dict(median=self.median, calls=self.calls, epochs=self.epochs)
+
+    def load_state_dict(self, state):
+        self.median = state['median']
+        self.calls = state['calls']
+        self.epochs = state['epochs']
+
+    def sampled_median(self, dist):
+        dist = dist.reshape(-1)
+        if dist.numel() <= self.n_pairs:
+            return th.median(dist)
+        idx = th.randint(dist.numel(), (self.n_pairs,), device=dist.device)
+        return th.median(dist[idx])
+
+
+def kernel_from_distance_matrix(dist, rel_sigma, min_sigma=EPSILON, bandwidth=None):
     """
     Compute a Gaussian kernel matrix from a distance matrix.
 
@@ -16,20 +89,28 @@ def kernel_from_distance_matrix(dist, rel_sigma, min_sigma=EPSILON):
     :type rel_sigma: float
     :param min_sigma: Minimum value for sigma. For numerical stability.
     :type min_sigma: float
+    :param bandwidth: Bandwidth estimator, the exact median of `dist` if None
+    :type bandwidth: median_bandwidth
     :return: Kernel matrix
     :rtype: th.Tensor
     """
     # `dist` can sometimes contain negative values due to floating point errors, so just set these to zero.
     dist = relu(dist)
+    sigma2 = _sigma2(dist, rel_sigma, min_sigma, bandwidth)
+    k = th.exp(- dist / (2 * sigma2))
+    return k
+
+
+def _sigma2(dist, rel_sigma, min_sigma=EPSILON, bandwidth=None):
+    if bandwidth is not None:
+        return bandwidth(dist, rel_sigma, min_sigma)
     sigma2 = rel_sigma * th.median(dist)
     # Disable gradient for sigma
     sigma2 = sigma2.detach()
-    sigma2 = th.where(sigma2 < min_sigma, sigma2.new_tensor(min_sigma), sigma2)
-    k = th.exp(- dist / (2 * sigma2))
-    return k
+    return th.where(sigma2 < min_sigma, sigma2.new_tensor(min_sigma), sigma2)
 
 
-def vector_kernel(x, rel_sigma=0.15):
+def vector_kernel(x, rel_sigma=0.15, bandwidth=None, chunk_size=512):
     """
     Compute a kernel matrix from the rows of a matrix.
 
@@ -37,10 +118,196 @@ def vector_kernel(x, rel_sigma=0.15):
     :type x: th.Tensor
     :param rel_sigma: Multiplication factor for the sigma hyperparameter
     :type rel_sigma: float
+    :param bandwidth: Bandwidth estimator, the exact median if None
+    :type bandwidth: median_bandwidth
+    :param chunk_size: Number of rows built at a time (see `gaussian_kernel`)
+    :type chunk_size: int
     :return: Kernel matrix
     :rtype: th.Tensor
     """
-    return kernel_from_distance_matrix(cdist(x, x), rel_sigma)
+    return gaussian_kernel(x, rel_sigma, bandwidth=bandwidth, chunk_size=chunk_size)
+
+
+def gaussian_kernel(x, rel_sigma=0.15, min_sigma=EPSILON, bandwidth=None, chunk_size=512):
+    """
+    Gaussian kernel matrix of the rows of a matrix, built in a single N x N buffer.
+
+    Same result as `kernel_from_distance_matrix(cdist(x, x), ...)`. The distances are written
+    block-row by block-row, computing only the blocks on and above the diagonal and mirroring them
+    below it. Clamping, scaling and the exponential then run in place, and the backward pass is
+    computed in row chunks, so no further N x N temporaries are kept for autograd.
+
+    :param x: Input matrix
+    :type x: th.Tensor
+    :param rel_sigma: Multiplication factor for the sigma hyperparameter
+    :type rel_sigma: float
+    :param min_sigma: Minimum value for sigma. For numerical stability.
+    :type min_sigma: float
+    :param bandwidth: Bandwidth estimator, the exact median if None
+    :type bandwidth: median_bandwidth
+    :param chunk_size: Number of rows per block, None for a single block
+    :type chunk_size: int
+    :return: Kernel matrix
+    :rtype: th.Tensor
+    """
+    return _GaussianKernel.apply(x, rel_sigma, min_sigma, bandwidth, chunk_size)
+
+
+def gaussian_kernel_matmul(x, A, rel_sigma=0.15, min_sigma=EPSILON, bandwidth=None, chunk_size=512):
+    """
+    Product K A of the Gaussian kernel matrix of the rows of `x` with a matrix `A`.
+
+    The kernel is built as in `gaussian_kernel`. Its gradient G A^T is formed in row chunks during the
+    backward pass instead of as an N x N matrix, so the kernel itself is the only N x N buffer.
+
+    :param x: Input matrix
+    :type x: th.Tensor
+    :param A: Matrix with one row per row of `x`
+    :type A: th.Tensor
+    :return: K A
+    :rtype: th.Tensor
+    """
+    return _GaussianKernelMatmul.apply(x, A, rel_sigma, min_sigma, bandwidth, chunk_size)
+
+
+def _build_gaussian_kernel(x, rel_sigma, min_sigma, bandwidth, step):
+    n = x.shape[0]
+    x2 = th.sum(x ** 2, dim=1)
+    k = x.new_empty(n, n)
+    for a in range(0, n, step):
+        b = min(a + step, n)
+        blk = k[a:b, a:]
+        th.addmm(x2[a:b, None], x[a:b], th.t(x[a:]), alpha=-2, out=blk)
+        blk.add_(x2[None, a:])
+        # Distances can come out slightly negative due to floating point errors, set these to zero
+        blk.clamp_(min=0)
+        k[b:, a:b] = th.t(blk[:, b - a:])
+
+    sigma2 = _sigma2(k, rel_sigma, min_sigma, bandwidth)
+    k.div_(-2 * sigma2).exp_()
+    return k, sigma2
+
+
+def _gaussian_kernel_grad(x, k, sigma2, grad_rows, step):
+    # dK_ij/dx_i = -K_ij / sigma2 * (x_i - x_j), zero where the distance was clamped (K_ij = 1)
+    n = x.shape[0]
+    grad_x = th.zeros_like(x)
+    col = x.new_zeros(n)
+    for a in range(0, n, step):
+        b = min(a + step, n)
+        m = grad_rows(a, b) * k[a:b]
+        m.masked_fill_(k[a:b] >= 1, 0)
+        grad_x[a:b] += m.sum(dim=1, keepdim=True) * x[a:b] - m @ x
+        grad_x -= th.t(m) @ x[a:b]
+        col += m.sum(dim=0)
+    grad_x += col[:, None] * x
+    grad_x *= -1 / sigma2
+    return grad_x
+
+
+class _GaussianKernel(th.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, rel_sigma, min_sigma, bandwidth, chunk_size):
+        step = x.shape[0] if chunk_size is None else max(chunk_size, 1)
+        with span('kernel_build'):
+            k, sigma2 = _build_gaussian_kernel(x, rel_sigma, min_sigma, bandwidth, step)
+        ctx.save_for_backward(x, k, sigma2)
+        ctx.step = step
+        return k
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, k, sigma2 = ctx.saved_tensors
+        with span('kernel_grad'):
+            grad_x = _gaussian_kernel_grad(x, k, sigma2, lambda a, b: grad[a:b], ctx.step)
+        return grad_x, None, None, None, None
+
+
+class _GaussianKernelMatmul(th.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, A, rel_sigma, min_sigma, bandwidth, chunk_size):
+        step = x.shape[0] if chunk_size is None else max(chunk_size, 1)
+        with span('kernel_build'):
+            k, sigma2 = _build_gaussian_kernel(x, rel_sigma, min_sigma, bandwidth, step)
+        ctx.save_for_backward(x, A, k, sigma2)
+        ctx.step = step
+        return k @ A
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, A, k, sigma2 = ctx.saved_tensors
+        grad_x = grad_A = None
+        if ctx.needs_input_grad[0]:
+            with span('kernel_grad'):
+                grad_x = _gaussian_kernel_grad(x, k, sigma2, lambda a, b: grad[a:b] @ th.t(A), ctx.step)
+        if ctx.needs_input_grad[1]:
+            # K is symmetric
+            grad_A = k @ grad
+        return grad_x, grad_A, None, None, None, None
+
+
+def nystrom_features(x, n_landmarks, rel_sigma=0.15, min_sigma=EPSILON, bandwidth=None):
+    """
+    Nystrom feature map Phi of the Gaussian kernel on the rows of a matrix, K ~ Phi Phi^T.
+
+    Landmarks are drawn uniformly from the rows of `x`. Sigma follows `kernel_from_distance_matrix`,
+    with the median taken over the distances to the landmarks. Gradients flow through the
+    sample-to-landmark kernel; the landmark kernel is inverted as a constant.
+
+    :param x: Input matrix
+    :type x: th.Tensor
+    :param n_landmarks: Number of landmarks, i.e. the rank of the approximation
+    :type n_landmarks: int
+    :param rel_sigma: Multiplication factor for the sigma hyperparameter
+    :type rel_sigma: float
+    :param min_sigma: Minimum value for sigma. For numerical stability.
+    :type min_sigma: float
+    :param bandwidth: Bandwidth estimator, the exact median if None
+    :type bandwidth: median_bandwidth
+    :return: Feature map with at most `n_landmarks` columns
+    :rtype: th.Tensor
+    """
+    with span('kernel_build'):
+        idx = th.randperm(x.shape[0], device=x.device)[:n_landmarks]
+        z = x[idx]
+        dist = relu(cdist(x, z))
+        sigma2 = _sigma2(dist, rel_sigma, min_sigma, bandwidth)
+        k_nz = th.exp(- dist / (2 * sigma2))
+        with th.no_grad():
+            k_zz = th.exp(- relu(cdist(z, z)) / (2 * sigma2))
+            D, V = th.linalg.eigh(k_zz)
+            keep = D > EPSILON * D.max()
+            root_inv = V[:, keep] * D[keep] ** -0.5
+        return k_nz @ root_inv
+
+
+def random_fourier_features(x, n_features, rel_sigma=0.15, min_sigma=EPSILON, bandwidth=None):
+    """
+    Random Fourier feature map Phi of the Gaussian kernel on the rows of a matrix, K ~ Phi Phi^T.
+
+    Sigma follows `kernel_from_distance_matrix`, with the median taken over the distances to a random
+    subset of `n_features` rows.
+
+    :param x: Input matrix
+    :type x: th.Tensor
+    :param n_features: Number of random features
+    :type n_features: int
+    :param rel_sigma: Multiplication factor for the sigma hyperparameter
+    :type rel_sigma: float
+    :param min_sigma: Minimum value for sigma. For numerical stability.
+    :type min_sigma: float
+    :param bandwidth: Bandwidth estimator, the exact median if None
+    :type bandwidth: median_bandwidth
+    :return: Feature map of shape (n, n_features)
+    :rtype: th.Tensor
+    """
+    with span('kernel_build'):
+        idx = th.randperm(x.shape[0], device=x.device)[:n_features]
+        sigma2 = _sigma2(relu(cdist(x, x[idx])), rel_sigma, min_sigma, bandwidth)
+        omega = th.randn(x.shape[1], n_features, device=x.device, dtype=x.dtype) / th.sqrt(sigma2)
+        b = 2 * math.pi * th.rand(n_features, device=x.device, dtype=x.dtype)
+        return math.sqrt(2 / n_features) * th.cos(x @ omega + b)
+
 
 def vector_kernel_half(x, rel_sigma=0.15):
     """
@@ -1,8 +1,16 @@
 from objectives import safe_loss
+from kernel import median_bandwidth
 from SDCC_model import *
+from precision import PrecisionPolicy, DTYPES
+from ensemble import EnsembleSolver
+from inference import Predictor
+from profiling import Profiler, span
 from utils import *
 import time
 import logging, math
+import os, json, hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 try:
     import cPickle as thepickle
 except ImportError:
@@ -12,6 +20,8 @@ seed_list = np.random.default_rng(seed=0).choice(10000, size=10, replace=False)
 
 logging.getLogger('matplotlib.font_manager').disabled = True
 
+# 'pytorch': per-component deflation, 'block': all components at once (see mdcp_loss.loss_block),
+# 'numpy': SciPy/LAPACK backend for CPU-only machines (see mdcp_loss.loss_numpy_fast)
 dcc_solver = 'pytorch'
 
 config = dict(
@@ -27,35 +37,115 @@ config = dict(
     lmbda3=0.01,
     r=1e-1,
     n_iter=10,
+    dcc_tol=None,
+    # Iterations between two convergence tests of dcc_tol, each test synchronises with the device
+    dcc_tol_every=1,
+    whitening='eigh',
+    whitening_cache_tol=None,
+    # Newton-Schulz iterations of whitening='newton_schulz', and calls between two tests of the cache
+    whitening_ns_iter=30,
+    whitening_cache_every=1,
+    multihead_dcp=False,
+    packed_views=False,
+    # Mini-batches of samples for the clustering loss, None trains on the full batch
+    batch_size=None,
+    batch_shuffle=True,
+    n_anchors=0,
+    # Hidden kernel of the clustering loss: 'exact', or rank-`ddc_kernel_rank` 'nystrom' / 'rff'
+    ddc_kernel='exact',
+    ddc_kernel_rank=256,
+    # Bandwidth of the hidden kernel: 'exact' median, 'sampled', 'ema' or 'frozen' (see kernel.median_bandwidth)
+    ddc_bandwidth='exact',
+    ddc_bandwidth_pairs=100000,
+    ddc_bandwidth_momentum=0.9,
+    ddc_bandwidth_warmup=10,
+    # Clustering scores every `eval_every` fine-tune epochs, on a background thread if `async_eval`
+    eval_every=1,
+    async_eval=True,
+    # Storage of the frozen DCP features during fine-tuning: 32, 16 (float16) or 'bf16', and an optional
+    # torch.compile mode for the gate + DDC + safe_loss step ('reduce-overhead' captures CUDA graphs)
+    finetune_feature_dtype=32,
+    finetune_compile=None,
+    # torch.compile mode for the Encoder/Decoder/DDC/WeightedMean modules (see SDCC_model.compile_model),
+    # None runs eagerly
+    compile=None,
+    compile_backend='inductor',
+    # Learning rate of the fine-tune phase, `lr` if None
+    finetune_lr=None,
+    # Checkpoints of fit every `checkpoint_every` epochs of both phases, a run resumes from its checkpoint
+    # if one exists. `warm_start` is a directory of phase-1 artifacts (models and frozen features), shared
+    # by all runs whose config only differs in FINETUNE_KEYS, so those runs skip phase 1
+    checkpoint_dir=None,
+    checkpoint_every=10,
+    warm_start=None,
+    # Directory to export the trained models to, for inference.Predictor
+    export=None,
+    # Per-stage timings (see profiling.Profiler): JSONL file with the span aggregates of every epoch, and a
+    # Chrome trace of `profile_trace_epochs` epochs
+    profile=None,
+    profile_trace=None,
+    profile_trace_epochs=2,
     t_time=0,
     dcc_dtype=64,
+    # Autocast dtype of the Encoder/Decoder/DDC MLPs: 32 (off), 16 (float16) or 'bf16', see precision.PrecisionPolicy
+    mlp_dtype=32,
     dec_loss='l21',
 
     dataset = 'Caltech-5v',
+    device='cuda',
 )
 
+# Config keys that do not change the trained model, and keys that only change the fine-tune phase. Both are
+# left out of the fingerprint of a checkpoint or phase-1 artifact (see run_files)
+RUNTIME_KEYS = ('eval_every', 'async_eval', 'finetune_compile', 'compile', 'compile_backend', 'checkpoint_dir',
+                'checkpoint_every', 'warm_start', 'export', 'profile', 'profile_trace', 'profile_trace_epochs', 't_time',
+                'device')
+FINETUNE_KEYS = ('finetune_lr', 'finetune_feature_dtype')
+
 class Solver():
     def __init__(self, old_model, new_model, gate, ddc_model, lmbda, lmbda2, lmbda3, dim, n_class, epoch_num, batch_size,
-                 learning_rate, reg_par, r, device=torch.device('cpu')):
+                 learning_rate, reg_par, r, device=torch.device('cpu'), batch_shuffle=True, n_anchors=0,
+                 cluster_kernel='exact', kernel_rank=256, bandwidth=None, eval_every=1, async_eval=True,
+                 feature_dtype=None, finetune_compile=None, precision=None, finetune_lr=None, checkpoint=None,
+                 checkpoint_every=10, warm_start=None, profiler=None):
+        # With a MultiHeadDCP as old_model and no new_model, both outputs come from one encoder pass
         self.old_model = old_model.to(device)
-        self.new_model = new_model.to(device)
+        self.new_model = new_model.to(device) if new_model is not None else None
+        self.dcp_models = [m for m in (self.old_model, self.new_model) if m is not None]
         self.gate = gate.to(device)
         self.ddc_model = ddc_model.to(device)
         self.epoch_num = epoch_num
         self.batch_size = batch_size
+        self.batch_shuffle = batch_shuffle
+        self.n_anchors = n_anchors
         self.lmbda = lmbda
         self.lmbda2 = lmbda2
         self.lmbda3 = lmbda3
         self.n_class = n_class
-        self.cluster_loss = safe_loss(n_class, device)
-        self.sdcp_optimizer = torch.optim.Adam(list(self.old_model.parameters()) + list(self.new_model.parameters())
-                                               + list(self.gate.parameters()) + list(self.ddc_model.parameters()),
-                                               lr=learning_rate, weight_decay=reg_par)
-        self.finetune_optimizer = torch.optim.Adam(list(self.gate.parameters()) + list(self.ddc_model.parameters()),
-                                               lr=learning_rate, weight_decay=reg_par)
+        self.cluster_loss = safe_loss(n_class, device, cluster_kernel, kernel_rank, bandwidth)
+        self.precision = precision if precision is not None else PrecisionPolicy(device)
+        self.sdcp_optimizer = self.precision.adam([p for m in self.dcp_models for p in m.parameters()]
+                                                  + list(self.gate.parameters()) + list(self.ddc_model.parameters()),
+                                                  lr=learning_rate, weight_decay=reg_par)
+        finetune_lr = finetune_lr if finetune_lr is not None else learning_rate
+        self.finetune_optimizer = self.precision.adam(list(self.gate.parameters()) + list(self.ddc_model.parameters()),
+                                                      lr=finetune_lr, weight_decay=reg_par)
         self.finetune_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(self.finetune_optimizer, T_max=150,
-                                                eta_min=learning_rate/10)
+                                                eta_min=finetune_lr/10)
         self.device = device
+        self.grad_scaler = self.precision.grad_scaler()
+        self.eval_every = eval_every
+        self.async_eval = async_eval
+        self.evaluator = None
+        self.feature_dtype = feature_dtype
+        self.finetune_step = self.finetune_forward
+        if finetune_compile is not None:
+            self.finetune_step = torch.compile(self.finetune_forward, mode=finetune_compile)
+
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.warm_start = warm_start
+        self.profiler = profiler
 
         self.dim = dim
         self.r = r
@@ -64,7 +154,265 @@ class Solver():
             level=logging.DEBUG, format="[ %(levelname)s : %(asctime)s ] - %(message)s")
         self.logger = logging.getLogger("Pytorch")
 
+    def dcp_forward(self, batch_x):
+        """
+        Outputs (eo, fused, dcp_loss, dec_loss) of the old and the new DCP model.
+        """
+        if self.new_model is None:
+            return self.old_model(batch_x)
+        return self.old_model(batch_x), self.new_model(batch_x)
+
+    def batches(self, n_sample):
+        """
+        Sample indices of the mini-batches of one epoch, [None] for the full batch. Every batch also
+        holds the anchor samples, so that all batch kernels share a common reference set.
+        """
+        if self.full_batch:
+            return [None]
+        samples = self.samples
+        if self.batch_shuffle:
+            samples = samples[torch.randperm(samples.shape[0], device=self.device)]
+        batches = list(torch.split(samples, self.batch_size))
+        # Fold a short tail into the previous batch rather than fitting a kernel on a handful of samples
+        if len(batches) > 1 and batches[-1].shape[0] < self.batch_size // 2:
+            batches[-2:] = [torch.cat(batches[-2:])]
+        if self.anchors is not None:
+            batches = [torch.cat([b, self.anchors]) for b in batches]
+        return batches
+
+    def batch_cluster_loss(self, hidden, output, batches):
+        """
+        safe_loss averaged over the kernels of the given mini-batches, so that memory grows with the
+        batch size instead of N^2.
+        """
+        if batches[0] is None:
+            return self.cluster_loss.forward_cluster(hidden, output)[0]
+        loss = 0
+        for idx in batches:
+            loss = loss + self.cluster_loss.forward_cluster(hidden[idx], output[idx])[0]
+        return loss / len(batches)
+
+    def cache_features(self, xt):
+        """
+        Fused features of the frozen DCP models, computed once for the whole fine-tune phase and stored as
+        one contiguous (2, N, cca_dim) buffer. They keep the DCP precision, so that checkpoints and phase-1
+        artifacts do not depend on `feature_dtype`, which fine-tuning casts them to.
+        """
+        for m in self.dcp_models:
+            m.eval()
+        with torch.no_grad():
+            (_, fused_old, _, _), (_, fused_new, _, _) = self.dcp_forward(xt)
+            features = torch.stack([fused_old, fused_new])
+        self.projections = [W for m in self.dcp_models for _, W in m.heads()]
+        return features.contiguous()
+
+    def finetune_forward(self, features):
+        """
+        Gate, DDC and clustering loss on a (2, n, cca_dim) slice of the cached features.
+        """
+        with span('gate'):
+            fused = self.gate(features.to(self.gate.weights.dtype).unbind(0))
+        output, hidden = self.ddc_forward(fused)
+        loss, train_loss = self.cluster_loss.forward_cluster(hidden, output)
+        return output, loss, train_loss
+
+    def ddc_forward(self, fused):
+        """
+        DDC module in the MLP precision, with float32 outputs for the clustering loss.
+        """
+        with span('ddc'), self.precision.mlp():
+            output, hidden = self.ddc_model(fused)
+        return self.precision.output(output, hidden)
+
+    def step(self, optimizer, loss):
+        """
+        Backward pass and optimizer step, through the loss scaler for float16 MLPs. The update of a
+        non-finite loss is skipped on the device, so the weights stay as they were before it; the run is
+        stopped once the evaluation thread has seen the loss (see `drain`).
+        """
+        with span('backward'):
+            self.grad_scaler.scale(loss).backward()
+        with span('optimizer'):
+            # An enabled scaler skips steps with non-finite gradients itself
+            if self.grad_scaler.is_enabled() or self.precision.skip_if_nonfinite(optimizer, loss):
+                self.grad_scaler.step(optimizer)
+            self.grad_scaler.update()
+
+    def to_host(self, t):
+        """
+        Host copy of a device tensor. On CUDA it goes through a pinned buffer without blocking, and is
+        only valid once an event recorded after the copy has completed.
+        """
+        t = t.detach()
+        if t.device.type != 'cuda':
+            return t
+        buf = torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+        buf.copy_(t, non_blocking=True)
+        return buf
+
+    def submit_epoch(self, info, losses, pred=None):
+        """
+        Queue the mean loss and, if given, the predicted labels of an epoch for evaluation. Nothing here
+        waits on the device; the copies are synchronised on the evaluation thread.
+        """
+        loss = self.to_host(torch.stack(losses).mean())
+        clbl = self.to_host(torch.argmax(pred, dim=1)) if pred is not None else None
+        event = None
+        if self.device.type == 'cuda':
+            event = torch.cuda.Event()
+            event.record()
+        self.pending.append((info, self.evaluator.submit(self.evaluate, event, loss, clbl, self.lbl)))
+        self.drain(wait=not self.async_eval)
+
+    @staticmethod
+    def evaluate(event, loss, clbl, lbl):
+        if event is not None:
+            event.synchronize()
+        loss = loss.item()
+        if clbl is None or math.isnan(loss):
+            return loss, None
+        with span('metrics', host=True):
+            return loss, cluster_eval(y_true=lbl, y_pred=clbl.numpy())
+
+    def drain(self, wait=False):
+        """
+        Log the evaluated epochs in order and keep the best scores. Stops at the first NaN loss, the
+        epochs queued after it are dropped.
+        """
+        while self.pending and not self.diverged and (wait or self.pending[0][1].done()):
+            (epoch, n_epoch, epoch_time, lr), future = self.pending.popleft()
+            loss, scores = future.result()
+            if math.isnan(loss):
+                self.diverged = True
+                self.pending.clear()
+                break
+            if lr is None:
+                info_string = "{:d} Epoch {:d}/{:d} - time: {:.2f} - training_loss: {:.4f}"
+                self.logger.info(info_string.format(self.times, epoch + 1, n_epoch, epoch_time, loss))
+            else:
+                info_string = "{:d} Epoch {:d}/{:d} - lr: {:.5f} - time: {:.2f} - training_loss: {:.4f}"
+                self.logger.info(info_string.format(self.times, epoch + 1, n_epoch, lr, epoch_time, loss))
+            if scores is None:
+                continue
+            nmi_score, pur_score, acc_score = scores
+            if self.nmi < nmi_score:
+                self.nmi = nmi_score
+                self.acc = acc_score
+                self.pur = pur_score
+                self.ep = epoch + 1
+
+    def state_dict(self, phase, epoch):
+        """
+        State of fit after `epoch` of `phase` (1: DCP training, 2: fine-tuning). Fine-tune states also
+        hold the frozen features and projections, so that the DCP models need not be run again.
+        """
+        bandwidth = self.cluster_loss.bandwidth
+        return dict(
+            phase=phase,
+            epoch=epoch,
+            dcp_models=[m.state_dict() for m in self.dcp_models],
+            dcc_solvers=[m.solver_state_dict() for m in self.dcp_models],
+            gate=self.gate.state_dict(),
+            ddc_model=self.ddc_model.state_dict(),
+            sdcp_optimizer=self.sdcp_optimizer.state_dict(),
+            finetune_optimizer=self.finetune_optimizer.state_dict(),
+            finetune_scheduler=self.finetune_scheduler.state_dict(),
+            grad_scaler=self.grad_scaler.state_dict(),
+            bandwidth=bandwidth.state_dict() if bandwidth is not None else None,
+            scores=(self.nmi, self.acc, self.pur, self.ep),
+            samples=None if self.full_batch else (self.samples, self.anchors),
+            features=self.features if phase == 2 else None,
+            projections=self.projections if phase == 2 else None,
+            rng=get_rng_state(),
+        )
+
+    def load_state_dict(self, state, warm_start=False):
+        """
+        Restore a state of fit. A warm start only takes the models, features and RNG states of a phase-1
+        artifact and keeps the fine-tune optimizer and schedule of this Solver.
+        """
+        for m, m_state, solver_state in zip(self.dcp_models, state['dcp_models'], state['dcc_solvers']):
+            m.load_state_dict(m_state)
+            m.load_solver_state_dict(solver_state)
+        self.gate.load_state_dict(state['gate'])
+        self.ddc_model.load_state_dict(state['ddc_model'])
+        self.grad_scaler.load_state_dict(state['grad_scaler'])
+        if not warm_start:
+            self.sdcp_optimizer.load_state_dict(state['sdcp_optimizer'])
+            self.finetune_optimizer.load_state_dict(state['finetune_optimizer'])
+            self.finetune_scheduler.load_state_dict(state['finetune_scheduler'])
+            self.nmi, self.acc, self.pur, self.ep = state['scores']
+        if state['bandwidth'] is not None:
+            self.cluster_loss.bandwidth.load_state_dict(state['bandwidth'])
+        if state['samples'] is not None:
+            self.samples, self.anchors = state['samples']
+        self.features = state['features']
+        self.projections = state['projections']
+        set_rng_state(state['rng'])
+
+    def restore(self):
+        """
+        Load the checkpoint of this run, or else the phase-1 artifact to warm start from.
+
+        :return: (phase, first epoch) to continue at, None when training from scratch
+        """
+        for path, warm_start in ((self.checkpoint, False), (self.warm_start, True)):
+            if path is None or not os.path.exists(path):
+                continue
+            state = torch.load(path, map_location=self.device, weights_only=False)
+            self.load_state_dict(state, warm_start)
+            self.logger.info("{:d} Restored phase {:d} epoch {:d} from {}".format(self.times, state['phase'],
+                                                                                 state['epoch'] + 1, path))
+            return state['phase'], state['epoch'] + 1
+        return None
+
+    def save_checkpoint(self, phase, epoch, n_epoch):
+        """
+        Checkpoint every `checkpoint_every` epochs and at the end of a phase, once the epochs before have
+        been evaluated.
+        """
+        if self.checkpoint is None or ((epoch + 1) % self.checkpoint_every != 0 and epoch + 1 != n_epoch):
+            return
+        self.drain(wait=True)
+        if not self.diverged:
+            save_state(self.state_dict(phase, epoch), self.checkpoint)
+
+    def export(self):
+        """
+        Predictor for new samples with the projections of the frozen DCP models and the current gate
+        and DDC, i.e. the model after the last fine-tune epoch. The best scores reported by fit may come
+        from an earlier epoch, which is not kept.
+        """
+        fusion = [f for m in self.dcp_models for f, _ in m.heads()]
+        return Predictor.from_modules(self.projections, fusion, self.gate, self.ddc_model)
+
+    def profile_epoch(self, phase, epoch, epoch_time):
+        if self.profiler is not None:
+            self.profiler.epoch(times=self.times, phase=phase, epoch=epoch + 1, time=epoch_time)
+
+    def end_epoch(self):
+        if self.cluster_loss.bandwidth is not None:
+            self.cluster_loss.bandwidth.epoch()
+
     def fit(self, x, lbl, times=0):
+        """
+        Train on the views `x` (N x d_v each), with the spans of every epoch recorded by `profiler` if set.
+        Afterwards `pred` holds the cluster probabilities of the last fine-tune epoch.
+
+        :return: Best NMI, ACC, PUR and the fine-tune epoch they were reached at
+        """
+        self.evaluator = ThreadPoolExecutor(max_workers=1)
+        try:
+            if self.profiler is None:
+                return self._fit(x, lbl, times)
+            with self.profiler.activate():
+                result = self._fit(x, lbl, times)
+            self.logger.info("{:d} Stage times - {}".format(times, self.profiler.summary()))
+            return result
+        finally:
+            self.evaluator.shutdown(wait=True)
+
+    def _fit(self, x, lbl, times=0):
         n_view = len(x)
         xt = []
         self.npx = []
@@ -77,113 +425,170 @@ class Solver():
         self.acc = 0
         self.pur = 0
         self.ep = self.epoch_num
-
-        self.full_batch = True
-
-        loss_list = []
-        nmi_list = []
-        acc_list = []
-        pur_list = []
-        for epoch in range(self.epoch_num):
-            train_losses = []
+        self.pred = None
+        self.lbl = lbl
+        self.times = times
+        self.pending = deque()
+        self.diverged = False
+
+        # The encoders take all samples at once (input size N), so the DCP pass stays full batch and
+        # mini-batches apply to the clustering loss; fine-tuning on the frozen features steps per batch.
+        n_sample = x[0].shape[0]
+        self.full_batch = self.batch_size is None or self.batch_size >= n_sample
+        self.features = None
+        self.projections = None
+        start = self.restore()
+        if start is None:
+            start = (1, 0)
+            if not self.full_batch:
+                perm = torch.randperm(n_sample, device=self.device)
+                self.anchors = perm[:self.n_anchors] if self.n_anchors > 0 else None
+                self.samples = torch.sort(perm[self.n_anchors:])[0]
+        phase, start_epoch = start
+
+        for epoch in range(start_epoch if phase == 1 else self.epoch_num, self.epoch_num):
             epoch_start_time = time.time()
 
-            self.old_model.train()
-            self.new_model.train()
+            for m in self.dcp_models:
+                m.train()
             self.gate.train()
             self.ddc_model.train()
             self.sdcp_optimizer.zero_grad()
 
             batch_x = xt
 
-            eo_old, fused_old, dcp_loss_old, dec_loss_old = self.old_model(batch_x)
-            eo_new, fused_new, dcp_loss_new, dec_loss_new = self.new_model(batch_x)
-            fused = self.gate([fused_old, fused_new])
+            (eo_old, fused_old, dcp_loss_old, dec_loss_old), (eo_new, fused_new, dcp_loss_new, dec_loss_new) = \
+                self.dcp_forward(batch_x)
+            with span('gate'):
+                fused = self.gate([fused_old, fused_new])
             dcp_loss = dcp_loss_old + dcp_loss_new
             dec_loss = dec_loss_old + dec_loss_new
 
-            output, hidden = self.ddc_model(fused)
+            output, hidden = self.ddc_forward(fused)
 
-            pred_vector = output.detach().cpu().numpy()
-            clbl = np.argmax(np.array(pred_vector), axis=1)
-
-            safe_loss, _ = self.cluster_loss.forward_cluster(hidden, output)
+            safe_loss = self.batch_cluster_loss(hidden, output, self.batches(n_sample))
             loss = self.lmbda * dcp_loss + self.lmbda2 * dec_loss + self.lmbda3 * safe_loss
 
-            if math.isnan(loss.item()):
-                return self.nmi, self.acc, self.pur, self.ep
-
-            train_losses.append(loss.item())
-            loss.backward()
-            self.sdcp_optimizer.step()
-
-            train_loss = np.mean(train_losses)
+            self.step(self.sdcp_optimizer, loss)
 
-            info_string = "{:d} Epoch {:d}/{:d} - time: {:.2f} - training_loss: {:.4f}"
             epoch_time = time.time() - epoch_start_time
-            loss_list.append(train_loss)
-            self.logger.info(info_string.format(
-                times, epoch + 1, self.epoch_num, epoch_time, train_loss))
-
-        self.old_model.eval()
-        self.new_model.eval()
-        batch_x = xt
-        with torch.no_grad():
-            eo_old_f, fused_old_f, dcp_loss_old_f, dec_loss_old_f = self.old_model(batch_x)
-            eo_new_f, fused_new_f, dcp_loss_new_f, dec_loss_new_f = self.new_model(batch_x)
-        for epoch in range(150):
+            self.submit_epoch((epoch, self.epoch_num, epoch_time, None), [loss.detach()])
+            self.profile_epoch(1, epoch, epoch_time)
+            self.end_epoch()
+            if self.diverged:
+                return self.nmi, self.acc, self.pur, self.ep
+            self.save_checkpoint(1, epoch, self.epoch_num)
+
+        self.drain(wait=True)
+        if self.diverged:
+            return self.nmi, self.acc, self.pur, self.ep
+
+        # The DCP models are frozen from here on, so their features are a fixed dataset
+        if phase == 1:
+            self.features = self.cache_features(xt)
+            if self.warm_start is not None:
+                save_state(self.state_dict(2, -1), self.warm_start)
+            start_epoch = 0
+        features = self.features
+        if self.feature_dtype is not None:
+            features = features.to(self.feature_dtype)
+        for epoch in range(start_epoch, 150):
             train_losses = []
             epoch_start_time = time.time()
 
             self.gate.train()
             self.ddc_model.train()
-            self.finetune_optimizer.zero_grad()
+            pred = None
+            for idx in self.batches(n_sample):
+                self.finetune_optimizer.zero_grad()
 
-            fused_old = fused_old_f.clone().detach()
-            fused_new = fused_new_f.clone().detach()
-            fused = self.gate([fused_old, fused_new])
+                output, loss, train_loss = self.finetune_step(features if idx is None else features[:, idx])
 
-            output, hidden = self.ddc_model(fused)
-
-            pred_vector = output.detach().cpu().numpy()
-            clbl = np.argmax(np.array(pred_vector), axis=1)
+                if idx is None:
+                    pred = output.detach()
+                else:
+                    if pred is None:
+                        pred = output.new_zeros(n_sample, output.shape[1])
+                    pred[idx] = output.detach()
 
-            safe_loss, _ = self.cluster_loss.forward_cluster(hidden, output)
-            loss = safe_loss
+                train_losses.append(train_loss)
+                self.step(self.finetune_optimizer, loss)
+            self.finetune_scheduler.step()
+            self.pred = pred
 
-            if math.isnan(loss.item()):
+            epoch_time = time.time() - epoch_start_time
+            lr = self.finetune_optimizer.param_groups[0]['lr']
+            evaluate = (epoch + 1) % self.eval_every == 0 or epoch + 1 == 150
+            self.submit_epoch((epoch, 150, epoch_time, lr), train_losses, pred if evaluate else None)
+            self.profile_epoch(2, epoch, epoch_time)
+            self.end_epoch()
+            if self.diverged:
                 return self.nmi, self.acc, self.pur, self.ep
+            self.save_checkpoint(2, epoch, 150)
 
-            train_losses.append(loss.item())
-            loss.backward()
-            self.finetune_optimizer.step()
-            self.finetune_scheduler.step()
+        self.drain(wait=True)
+        return self.nmi, self.acc, self.pur, self.ep
 
-            nmi_score, pur_score, acc_score = cluster_eval(y_true=lbl, y_pred=clbl)
-            nmi_list.append(nmi_score)
-            pur_list.append(pur_score)
-            acc_list.append(acc_score)
 
-            if self.nmi < nmi_score:
-                self.nmi = nmi_score
-                self.acc = acc_score
-                self.pur = pur_score
-                self.ep = epoch + 1
+def set_seed(seed):
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    np.random.seed(seed)
 
-            train_loss = np.mean(train_losses)
 
-            info_string = "{:d} Epoch {:d}/{:d} - lr: {:.5f} - time: {:.2f} - training_loss: {:.4f}"
-            epoch_time = time.time() - epoch_start_time
-            loss_list.append(train_loss)
-            self.logger.info(info_string.format(
-                times, epoch + 1, 150, self.finetune_optimizer.param_groups[0]['lr'], epoch_time, train_loss))
+def get_rng_state():
+    return dict(torch=torch.get_rng_state(), numpy=np.random.get_state(),
+                cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
 
-        return self.nmi, self.acc, self.pur, self.ep
 
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'].cpu())
+    np.random.set_state(state['numpy'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
 
-def main(X, lbl, N_sample, N_sam_fea, n_class, times=0):
-    device = torch.device('cuda')
-    print("Using", torch.cuda.device_count(), "GPUs")
+
+def save_state(state, path):
+    """
+    torch.save through a temporary file, so that an interrupted save leaves the previous file intact.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def fingerprint(exclude=(), cfg=None):
+    """
+    Short hash of `cfg` (by default `config`) and the solver choice, without RUNTIME_KEYS and `exclude`.
+    """
+    cfg = cfg if cfg is not None else config
+    keys = sorted(k for k in cfg if k not in RUNTIME_KEYS and k not in exclude)
+    items = dict({k: cfg[k] for k in keys}, dcc_solver=dcc_solver)
+    return hashlib.sha1(json.dumps(items, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def run_files(times):
+    """
+    Checkpoint and phase-1 artifact paths of run `times` from `config`. The checkpoint belongs to the
+    exact config, the artifact is shared across configs that only differ in FINETUNE_KEYS.
+    """
+    files = dict(checkpoint_every=config['checkpoint_every'])
+    if config['checkpoint_dir'] is not None:
+        files['checkpoint'] = os.path.join(config['checkpoint_dir'], '{}-{:d}-{}.pt'.format(
+            config['dataset'], times, fingerprint()))
+    if config['warm_start'] is not None:
+        files['warm_start'] = os.path.join(config['warm_start'], '{}-{:d}-{}.pt'.format(
+            config['dataset'], times, fingerprint(FINETUNE_KEYS)))
+    return files
+
+
+def build(N_sample, N_sam_fea, n_class):
+    """
+    Models and Solver arguments from `config`.
+
+    :return: (old_model, new_model, gate, ddc_model) and the keyword arguments of Solver
+    """
+    device = torch.device(config['device'])
 
     n_view = config['n_view']
 
@@ -191,10 +596,16 @@ def main(X, lbl, N_sample, N_sam_fea, n_class, times=0):
     dim = config['dim']
 
     learning_rate = config['lr']
-    batch_size = max(N_sam_fea)
+    batch_size = config['batch_size']
 
     r = config['r']
     n_iter = config['n_iter']
+    dcc_tol = config['dcc_tol']
+    dcc_tol_every = config['dcc_tol_every']
+    whitening_method = config['whitening']
+    whitening_cache_tol = config['whitening_cache_tol']
+    whitening_ns_iter = config['whitening_ns_iter']
+    whitening_cache_every = config['whitening_cache_every']
 
     cca_dim = min(dim, min(N_sam_fea))
 
@@ -211,25 +622,93 @@ def main(X, lbl, N_sample, N_sam_fea, n_class, times=0):
     else:
         dcc_dtype = torch.float32
     dec_loss_type = config['dec_loss']
+    feature_dtype = DTYPES[config['finetune_feature_dtype']]
+    precision = PrecisionPolicy(device, DTYPES[config['mlp_dtype']], dcc_dtype)
     epoch_num = 21
 
-    old_model = DCP(input_size, hidden_size, output_size, n_view - 1, cca_dim, r, device, n_iter=n_iter, dcc_solver=dcc_solver, dcc_dtype=dcc_dtype, dec_loss_type=dec_loss_type)
-    new_model = DCP(input_size, hidden_size, output_size, n_view, cca_dim, r, device, n_iter=n_iter, dcc_solver=dcc_solver, dcc_dtype=dcc_dtype, dec_loss_type=dec_loss_type)
+    dcp_kwargs = dict(n_iter=n_iter, dcc_solver=dcc_solver, dcc_dtype=dcc_dtype, dec_loss_type=dec_loss_type,
+                      dcc_tol=dcc_tol, dcc_tol_every=dcc_tol_every, whitening_method=whitening_method,
+                      whitening_cache_tol=whitening_cache_tol,
+                      whitening_ns_iter=whitening_ns_iter, whitening_cache_every=whitening_cache_every,
+                      packed=config['packed_views'], precision=precision)
+    if config['multihead_dcp']:
+        # One shared encoder/decoder pass feeds both covariation solves
+        old_model = MultiHeadDCP(input_size, hidden_size, output_size, [n_view - 1, n_view], cca_dim, r, device, **dcp_kwargs)
+        new_model = None
+    else:
+        old_model = DCP(input_size, hidden_size, output_size, n_view - 1, cca_dim, r, device, **dcp_kwargs)
+        new_model = DCP(input_size, hidden_size, output_size, n_view, cca_dim, r, device, **dcp_kwargs)
 
     gate = WeightedMean(2)
     ddc_model = DDC(cca_dim, n_class)
 
+    if config['compile'] is not None:
+        for model in (old_model, new_model, gate, ddc_model):
+            if model is not None:
+                compile_model(model, mode=config['compile'], backend=config['compile_backend'])
+
+    bandwidth = None
+    if config['ddc_bandwidth'] != 'exact':
+        bandwidth = median_bandwidth(config['ddc_bandwidth'], n_pairs=config['ddc_bandwidth_pairs'],
+                                     momentum=config['ddc_bandwidth_momentum'], warmup=config['ddc_bandwidth_warmup'])
+
     lmbda = config['lmbda']
     lmbda2 = config['lmbda2']
     lmbda3 = config['lmbda3']
 
-    solver = Solver(old_model, new_model, gate, ddc_model, lmbda, lmbda2, lmbda3, dim, n_class, epoch_num, batch_size,
-                    learning_rate, reg_par, r, device)
+    solver_kwargs = dict(lmbda=lmbda, lmbda2=lmbda2, lmbda3=lmbda3, dim=dim, n_class=n_class, epoch_num=epoch_num,
+                         batch_size=batch_size, learning_rate=learning_rate, reg_par=reg_par, r=r, device=device,
+                         batch_shuffle=config['batch_shuffle'], n_anchors=config['n_anchors'],
+                         cluster_kernel=config['ddc_kernel'], kernel_rank=config['ddc_kernel_rank'], bandwidth=bandwidth,
+                         eval_every=config['eval_every'], async_eval=config['async_eval'], feature_dtype=feature_dtype,
+                         finetune_compile=config['finetune_compile'], precision=precision,
+                         finetune_lr=config['finetune_lr'])
+    return (old_model, new_model, gate, ddc_model), solver_kwargs
+
+
+def main(X, lbl, N_sample, N_sam_fea, n_class, times=0):
+    models, solver_kwargs = build(N_sample, N_sam_fea, n_class)
+    profiler = None
+    if config['profile'] is not None or config['profile_trace'] is not None:
+        profiler = Profiler(solver_kwargs['device'], config['profile'], config['profile_trace'],
+                            config['profile_trace_epochs'])
+    solver = Solver(*models, **solver_kwargs, **run_files(times), profiler=profiler)
+    solver.logger.info("Using {:d} GPUs".format(torch.cuda.device_count()))
 
     nmi, acc, pur, ep = solver.fit(X, lbl, times=times)
+    if profiler is not None:
+        profiler.close()
+    if config['export'] is not None and not solver.diverged:
+        os.makedirs(config['export'], exist_ok=True)
+        predictor = solver.export()
+        predictor.save(os.path.join(config['export'], '{}-{:d}.pt'.format(config['dataset'], times)))
+        nmi_last, pur_last, acc_last = cluster_eval(y_true=lbl, y_pred=predictor.predict(X))
+        solver.logger.info("{:d} Exported the last epoch: NMI score: {:.2f}%, PUR score: {:.2f}%, ACC score: {:.2f}%"
+                           .format(times, nmi_last * 100, pur_last * 100, acc_last * 100))
 
     return nmi, pur, acc, ep
 
+
+def main_ensemble(X, lbl, N_sample, N_sam_fea, n_class, seeds, times=0):
+    """
+    One model per seed, initialised as main would after set_seed(seed), all trained in a single
+    batched run (see ensemble.EnsembleSolver).
+
+    :return: (nmi, pur, acc, ep) of every seed
+    """
+    members = []
+    bandwidths = []
+    for seed in seeds:
+        set_seed(seed)
+        models, solver_kwargs = build(N_sample, N_sam_fea, n_class)
+        members.append(models)
+        bandwidths.append(solver_kwargs.pop('bandwidth'))
+    solver_kwargs['async_eval'] = False
+    solver = EnsembleSolver(members, bandwidth=bandwidths, **solver_kwargs)
+    solver.logger.info("Using {:d} GPUs".format(torch.cuda.device_count()))
+
+    return [(nmi, pur, acc, ep) for nmi, acc, pur, ep in solver.fit(X, lbl, times=times)]
+
 if __name__ == '__main__':
     t_time = config['t_time']
     dataset = config['dataset']
@@ -239,12 +718,11 @@ if __name__ == '__main__':
 
     t_idx = t_time
     SEED = seed_list[t_idx]
-    torch.manual_seed(SEED)
-    torch.cuda.manual_seed(SEED)
-    np.random.seed(SEED)
+    set_seed(SEED)
 
     nmi, pur, acc, ep = main(X, lbl, N_sample, N_sam_fea, n_class, times=t_idx)
 
-    print("=====================================================")
-    print('Final: NMI score: {:.2f}%, PUR score: {:.2f}%, ACC score: {:.2f}%'
-          .format(nmi * 100, pur * 100, acc * 100))
+    logger = logging.getLogger("Pytorch")
+    logger.info("=====================================================")
+    logger.info('Final: NMI score: {:.2f}%, PUR score: {:.2f}%, ACC score: {:.2f}%'
+                .format(nmi * 100, pur * 100, acc * 100))
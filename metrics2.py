@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.optimize import linear_sum_assignment
 from sklearn.metrics import normalized_mutual_info_score, adjusted_rand_score
 from sklearn import metrics
 
@@ -33,4 +34,90 @@ def acc(y_true, y_pred):
     from scipy.optimize import linear_sum_assignment as linear_assignment
     ind = linear_assignment(w.max() - w)
     ind = np.array(ind).T
-    return sum([w[i, j] for i, j in ind]) * 1.0 / y_pred.size
\ No newline at end of file
+    return sum([w[i, j] for i, j in ind]) * 1.0 / y_pred.size
+
+
+def contingency(y_true, y_pred):
+    """
+    Contingency matrix C[i, j] = #samples of class i assigned to cluster j, from a single bincount.
+    Labels are used as indices directly when they are non-negative integers below the number of
+    samples, so classes/clusters that do not occur give empty rows/columns, which none of the scores
+    below are affected by. Other labels (e.g. hashed ids) are compressed to 0..k-1 first, which keeps
+    C at most n x n.
+    """
+    y_true = np.asarray(y_true).ravel()
+    y_pred = np.asarray(y_pred).ravel()
+    if y_true.shape != y_pred.shape:
+        raise ValueError("y_true and y_pred must have same size, got %d and %d" % (y_true.size, y_pred.size))
+    if y_true.size == 0:
+        return np.zeros((0, 0), dtype=np.int64)
+    y_true = _label_index(y_true)
+    y_pred = _label_index(y_pred)
+    n_classes, n_clusters = y_true.max() + 1, y_pred.max() + 1
+    C = np.bincount(y_true * n_clusters + y_pred, minlength=n_classes * n_clusters)
+    return C.reshape(n_classes, n_clusters)
+
+
+def _label_index(labels):
+    if labels.dtype.kind not in 'iub' or labels.min() < 0 or labels.max() >= labels.size:
+        labels = np.unique(labels, return_inverse=True)[1]
+    return labels.astype(np.int64)
+
+
+def _entropy(counts, n):
+    p = counts[counts > 0] / n
+    return -np.sum(p * np.log(p))
+
+
+def _comb2(x):
+    x = x.astype(np.float64)
+    return np.sum(x * (x - 1) / 2)
+
+
+def cluster_scores(y_true=None, y_pred=None, C=None):
+    """
+    All clustering scores from one contingency matrix.
+
+    NMI uses the arithmetic mean normalisation and ARI the adjusted pair counting of sklearn, ACC
+    the optimal one-to-one class/cluster matching, F the pair counting F-measure of `metrics.f_measure`.
+
+    # Arguments
+        y_true, y_pred: true and predicted labels, numpy.array with shape `(n_samples,)`
+        C: precomputed contingency matrix, used instead of the labels if given
+
+    # Return
+        dict with keys nmi, ari, pur, acc, f
+    """
+    if C is None:
+        C = contingency(y_true, y_pred)
+    n = C.sum()
+    rows, cols = C.sum(axis=1), C.sum(axis=0)
+
+    # NMI
+    nz = C > 0
+    Cnz = C[nz].astype(np.float64)
+    outer = np.outer(rows, cols)[nz].astype(np.float64)
+    mi = np.sum(Cnz / n * (np.log(Cnz) + np.log(n) - np.log(outer)))
+    h_true, h_pred = _entropy(rows, n), _entropy(cols, n)
+    if h_true == 0 and h_pred == 0:
+        nmi = 1.0
+    else:
+        nmi = max(mi, 0) / max((h_true + h_pred) / 2, np.finfo(np.float64).eps)
+
+    # ARI and pair counting F-measure
+    tp, tp_fp, tp_fn = _comb2(C), _comb2(rows), _comb2(cols)
+    prod = tp_fp * tp_fn / (n * (n - 1) / 2) if n > 1 else 0.
+    mean = (tp_fp + tp_fn) / 2
+    ari = 1.0 if mean == prod else (tp - prod) / (mean - prod)
+    if tp == 0:
+        f = 1.0 if tp_fp == tp_fn == 0 else 0.
+    else:
+        P, R = tp / tp_fp, tp / tp_fn
+        f = 2 * P * R / (P + R)
+
+    # Purity and ACC
+    pur = np.sum(np.amax(C, axis=0)) / n
+    r, c = linear_sum_assignment(C, maximize=True)
+    acc = C[r, c].sum() / n
+
+    return {'nmi': float(nmi), 'ari': float(ari), 'pur': float(pur), 'acc': float(acc), 'f': float(f)}
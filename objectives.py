@@ -1,30 +1,125 @@
 import torch
 import torch.nn as nn
 import numpy as np
-import scipy
+import scipy.linalg
 from torch import linalg as LA
 from kernel import *
-import time
+from profiling import span
 EPSILON = 1E-9
 
+class whitening():
+    """
+    Inverse square roots Sii^-1/2 of the per-view covariances Sii = Xi Xi^T + rI.
+
+    :param r: Ridge added to every covariance
+    :param eps: Eigenvalues of Sii at or below `eps` are dropped (their coefficient is zeroed, so that
+                shapes do not depend on the data and the device is never synchronised)
+    :param method: 'eigh' full eigendecomposition of Sii.
+                   'lowrank' top eigenpairs only, taken from a thin SVD of Xi. Sii has eigenvalue r on
+                   the rest of the space, so this is exact and costs O(d m^2) instead of O(d^3).
+                   'newton_schulz' coupled Newton-Schulz iteration, matmuls only.
+    :param ns_iter: Number of Newton-Schulz iterations
+    :param cache_tol: If set, the last Sii^-1/2 of a view is reused while the view has moved by less
+                      than `cache_tol` relative to the input it was computed from (Frobenius norm)
+    :param cache_every: Test the cache every `cache_every` calls of a view and keep the outcome in
+                        between. The test reads a norm back from the device, so this bounds the host
+                        syncs of the cache to one per `cache_every` calls
+    """
+    def __init__(self, r, eps, method='eigh', ns_iter=30, cache_tol=None, cache_every=1):
+        if method not in ('eigh', 'lowrank', 'newton_schulz'):
+            raise ValueError("unknown whitening method: {}".format(method))
+        self.r = r
+        self.eps = eps
+        self.method = method
+        self.ns_iter = ns_iter
+        self.cache_tol = cache_tol
+        self.cache_every = cache_every
+        self.cache = {}
+        self.calls = {}
+        self.hits = {}
+
+    def root_inv(self, key, X):
+        """
+        :param key: Cache key of the view
+        :param X: View embedding of shape (d, m)
+        :return: Sii^-1/2 of shape (d, d)
+        """
+        if self.cache_tol is not None and key in self.cache:
+            X_prev, srinv = self.cache[key]
+            calls = self.calls.get(key, 0)
+            self.calls[key] = calls + 1
+            if X_prev.shape == X.shape and X_prev.dtype == X.dtype:
+                if calls % self.cache_every == 0:
+                    self.hits[key] = bool(torch.linalg.norm(X - X_prev) <= self.cache_tol * torch.linalg.norm(X_prev))
+                if self.hits.get(key, False):
+                    return srinv
+
+        if self.method == 'lowrank':
+            srinv = self._root_inv_lowrank(X)
+        elif self.method == 'newton_schulz':
+            srinv = self._root_inv_newton_schulz(X)
+        else:
+            srinv = self._root_inv_eigh(X)
+
+        if self.cache_tol is not None:
+            self.cache[key] = (X.detach().clone(), srinv)
+        return srinv
+
+    def state_dict(self):
+        return dict(cache=dict(self.cache), calls=dict(self.calls), hits=dict(self.hits))
+
+    def load_state_dict(self, state):
+        self.cache = dict(state['cache'])
+        self.calls = dict(state['calls'])
+        self.hits = dict(state['hits'])
+
+    def _root_inv_eigh(self, X):
+        d = X.shape[0]
+        sii = torch.matmul(X, X.t()) + self.r * torch.eye(d, device=X.device, dtype=X.dtype)
+        [D, V] = torch.linalg.eigh(sii)
+        coef = torch.where(D > self.eps, D.clamp_min(self.eps) ** -0.5, 0.)
+        return torch.matmul(V * coef, V.t())
+
+    def _root_inv_lowrank(self, X):
+        d = X.shape[0]
+        U, S, _ = torch.linalg.svd(X, full_matrices=False)
+        D = S ** 2 + self.r
+        rinv = self.r ** -0.5 if self.r > self.eps else 0.
+        coef = torch.where(D > self.eps, D.clamp_min(self.eps) ** -0.5 - rinv, 0.)
+        return rinv * torch.eye(d, device=X.device, dtype=X.dtype) + torch.matmul(U * coef, U.t())
+
+    def _root_inv_newton_schulz(self, X):
+        d = X.shape[0]
+        eye = torch.eye(d, device=X.device, dtype=X.dtype)
+        # The iteration cannot drop eigenvalues as the eigh path does, they are floored at eps instead
+        sii = torch.matmul(X, X.t()) + max(self.r, self.eps) * eye
+        # Scale the spectrum into (0, 1] for convergence
+        c = torch.linalg.norm(sii)
+        Y = sii / c
+        Z = eye
+        for _ in range(self.ns_iter):
+            T = 0.5 * (3 * eye - torch.matmul(Z, Y))
+            Y = torch.matmul(Y, T)
+            Z = torch.matmul(T, Z)
+        return Z / torch.sqrt(c)
+
 class dcp_loss():
-    def __init__(self, dim, r, device, dtype=torch.float32):
+    def __init__(self, dim, r, device, dtype=torch.float32, whitening_method='eigh', whitening_cache_tol=None,
+                 numpy_export=False, whitening_ns_iter=30, whitening_cache_every=1):
         self.dim = dim
         self.r = r
         self.device = device
         self.dtype = dtype
+        self.numpy_export = numpy_export
+        self.whitening = whitening(r, 1e-9, whitening_method, whitening_ns_iter, whitening_cache_tol,
+                                   whitening_cache_every)
 
     def loss(self, H):
         H1 = H[0]
         H2 = H[1]
 
-        r1 = self.r
-        r2 = self.r
         eps = 1e-9
 
-        o1 = H1.size(0)
-        o2 = H2.size(0)
-
         with torch.no_grad():
             if self.dtype == torch.float64:
                 H1bar = H1.double()
@@ -34,29 +129,16 @@ class dcp_loss():
                 H2bar = H2
 
             SigmaHat12 = torch.matmul(H1bar, H2bar.t())
-            SigmaHat11 = torch.matmul(H1bar, H1bar.t()) + r1 * torch.eye(o1, device=self.device, dtype=self.dtype)
-            SigmaHat22 = torch.matmul(H2bar, H2bar.t()) + r2 * torch.eye(o2, device=self.device, dtype=self.dtype)
-
-            [D1, V1] = torch.linalg.eigh(SigmaHat11)
-            [D2, V2] = torch.linalg.eigh(SigmaHat22)
-
-            posInd1 = torch.gt(D1, eps).nonzero()[:, 0]
-            D1 = D1[posInd1]
-            V1 = V1[:, posInd1]
-            posInd2 = torch.gt(D2, eps).nonzero()[:, 0]
-            D2 = D2[posInd2]
-            V2 = V2[:, posInd2]
-
-            SigmaHat11RootInv = torch.matmul(
-                torch.matmul(V1, torch.diag(D1 ** -0.5)), V1.t())
-            SigmaHat22RootInv = torch.matmul(
-                torch.matmul(V2, torch.diag(D2 ** -0.5)), V2.t())
+            with span('whitening'):
+                SigmaHat11RootInv = self.whitening.root_inv(0, H1bar)
+                SigmaHat22RootInv = self.whitening.root_inv(1, H2bar)
 
             Tval = torch.matmul(torch.matmul(SigmaHat11RootInv,
                                              SigmaHat12), SigmaHat22RootInv)
 
-        U, S, V = torch.linalg.svd(Tval)
-        S = torch.where(S > eps, S, (torch.ones(S.shape) * eps).to(self.device))
+        with span('eigensolve'):
+            U, S, V = torch.linalg.svd(Tval)
+        S = torch.where(S > eps, S, S.new_tensor(eps))
         S = S.topk(self.dim)[0]
         corr = torch.sum(S)
         if self.dtype == torch.float64:
@@ -65,19 +147,91 @@ class dcp_loss():
         W = []
         W1 = torch.matmul(SigmaHat11RootInv, U[:, 0:self.dim])
         W2 = torch.matmul(SigmaHat22RootInv, V[:, 0:self.dim])
-        W.append(W1.detach().cpu().numpy())
-        W.append(W2.detach().cpu().numpy())
+        W.append(W1.detach())
+        W.append(W2.detach())
+        if self.numpy_export:
+            W = [w.cpu().numpy() for w in W]
+        else:
+            W = [w.float() for w in W]
 
         return -corr, W
 
 class mdcp_loss():
-    def __init__(self, dim, r, device=torch.device('cuda'), n_iter=15, dcc_dtype=torch.float32):
+    def __init__(self, dim, r, device=torch.device('cuda'), n_iter=15, dcc_dtype=torch.float32, tol=None,
+                 whitening_method='eigh', whitening_cache_tol=None, numpy_export=False, whitening_ns_iter=30,
+                 whitening_cache_every=1, tol_every=1):
         self.dim = dim
         self.r = r
         self.device = device
         self.n_iter = n_iter
         self.eps = 1e-6
         self.dtype = dcc_dtype
+        self.tol = tol
+        self.tol_every = tol_every
+        self.numpy_export = numpy_export
+        self.whitening = whitening(r, self.eps, whitening_method, whitening_ns_iter, whitening_cache_tol,
+                                   whitening_cache_every)
+
+    def _whiten(self, X):
+        """
+        Whiten every view with the inverse square root of Sii = Xi Xi^T + rI (see `whitening`).
+
+        :param X: List of view embeddings, each of shape (d_i, m)
+        :type X: list[th.Tensor]
+        :return: View sizes, view offsets in the stacked layout, block-diagonal Sii^-1/2 and the
+                 stacked whitened embeddings
+        :rtype: tuple
+        """
+        dtype = self.dtype
+        v = len(X)
+
+        d_list = []
+        s_list = []
+        d_sum = 0
+        for i in range(v):
+            d_list.append(X[i].shape[0])
+            s_list.append(d_sum)
+            d_sum += d_list[i]
+
+        siiRootInv = []
+        for i in range(v):
+            siiRootInv.append(self.whitening.root_inv(i, X[i].to(dtype)))
+
+        # A[i, j] = Sii^-1/2 Xi Xj^T Sjj^-1/2 for every view pair, so whitening the stacked
+        # embeddings once gives the whole matrix as a single symmetric product.
+        H = torch.cat(X, dim=0).to(dtype)
+        siiRootInv_bd = torch.block_diag(*siiRootInv)
+        Hw = torch.matmul(siiRootInv_bd, H)
+        return d_list, s_list, siiRootInv_bd, Hw
+
+    def _projections(self, siiRootInv_bd, V, d_list, s_list):
+        WV = torch.matmul(siiRootInv_bd, V)
+        W = []
+        for i in range(len(d_list)):
+            di = d_list[i]
+            si = s_list[i]
+            W.append(WV[si:si+di, :])
+        return W
+
+    def _output(self, X, W):
+        """
+        Loss and projections of a solve. The projections stay on the device as float32 tensors,
+        with `numpy_export` they are copied to the host in the solver precision instead.
+        """
+        Wf = [w.float() for w in W]
+        if self.numpy_export:
+            return self._corr(X, Wf), [w.cpu().numpy() for w in W]
+        return self._corr(X, Wf), Wf
+
+    def _corr(self, X, W):
+        corr = 0
+        for i in range(len(X)):
+            for j in range(len(X)):
+                sij = torch.matmul(X[i], X[j].t())
+                corr += torch.matmul(
+                    torch.matmul(W[i][:, 1].t(), sij), W[j][:, 1]
+                )
+        return -torch.abs(corr)
 
     def loss(self, X):
         dtype = self.dtype
@@ -85,98 +239,184 @@ class mdcp_loss():
         v = len(X)
 
         with torch.no_grad():
-            d_list = []
-            for i in range(v):
-                d_list.append(X[i].shape[0])
+            with span('whitening'):
+                d_list, s_list, siiRootInv_bd, Hw = self._whiten(X)
             d_sum = sum(d_list)
-            A = torch.zeros(d_sum, d_sum, device=self.device, dtype=dtype)
-
-            ts = time.time()
-            siiRootInv = []
-            for i in range(v):
-                sii = torch.matmul(X[i], X[i].t())
-                sii = sii + self.r * torch.eye(d_list[i], device=self.device, dtype=dtype)
-                [D, V] = torch.linalg.eigh(sii)
-                idx = D > self.eps
-                V = V[:, idx]
-                D = D[idx]
-                srinv = torch.matmul(torch.matmul(
-                    V, torch.diag(D ** -0.5)), V.t()
-                )
-                siiRootInv.append(srinv)
-
-            ts2 = time.time()
-            for i in range(v):
-                di = d_list[i]
-                si = sum(d_list[0:i])
-                for j in range(v):
-                    dj = d_list[j]
-                    sj = sum(d_list[0:j])
 
-                    if dtype == torch.float64:
-                        sij = torch.matmul(X[i], X[j].t()).double()
-                    else:
-                        sij = torch.matmul(X[i], X[j].t())
-                    A[si:si+di, sj:sj+dj] = torch.matmul(torch.matmul(
-                        siiRootInv[i], sij), siiRootInv[j]
-                    )
+            with span('a_assembly'):
+                A = torch.matmul(Hw, Hw.t())
 
             V = torch.ones(d_sum, self.dim, device=self.device, dtype=dtype)
 
             n_iter = self.n_iter
 
-            ts3 = time.time()
             for i in range(v):
                 di = d_list[i]
-                si = sum(d_list[0:i])
+                si = s_list[i]
                 for k in range(self.dim):
                     V[si:si+di, k] = V[si:si+di, k] / torch.linalg.vector_norm(V[si:si+di, k])
 
-            t1 = 0
-            t2 = 0
             for k in range(self.dim):
-                t11 = time.time()
-                if k == 0:
-                    S = A
-                else:
-                    W = torch.zeros(d_sum, v*k, device=self.device, dtype=dtype)
-                    for i in range(v):
-                        di = d_list[i]
-                        si = sum(d_list[0:i])
-                        W[si:si+di, i*k:(i+1)*k] = V[si:si+di, 0:k]
-                    S = (A - torch.matmul(torch.matmul(W, W.t()), A))
-                t1 += time.time() - t11
+                # Deflation of A by the components found so far
+                with span('a_assembly'):
+                    if k == 0:
+                        S = A
+                    else:
+                        W = torch.zeros(d_sum, v*k, device=self.device, dtype=dtype)
+                        for i in range(v):
+                            di = d_list[i]
+                            si = s_list[i]
+                            W[si:si+di, i*k:(i+1)*k] = V[si:si+di, 0:k]
+                        S = (A - torch.matmul(torch.matmul(W, W.t()), A))
 
-                t22 = time.time()
-                for n in range(n_iter):
-                    for i in range(v):
-                        di = d_list[i]
-                        si = sum(d_list[0:i])
+                with span('power_iteration'):
+                    for n in range(n_iter):
+                        for i in range(v):
+                            di = d_list[i]
+                            si = s_list[i]
+
+                            y = torch.matmul(S[si:si+di, :], V[:, k])
+                            ilam = torch.pow(torch.sum(torch.pow(y, 2)), -0.5)
+                            V[si:si + di, k] = y * ilam
 
-                        y = torch.matmul(S[si:si+di, :], V[:, k])
-                        ilam = torch.pow(torch.sum(torch.pow(y, 2)), -0.5)
-                        V[si:si + di, k] = y * ilam
+            W = self._projections(siiRootInv_bd, V, d_list, s_list)
 
-                t2 += time.time() - t22
+        return self._output(X, W)
 
-            W = []
-            Wn = []
+    def loss_block(self, X):
+        """
+        Multi-view DCC solved for all `dim` components at once.
+
+        Instead of deflating A once per component, every view keeps an orthonormal block of `dim`
+        directions and all blocks are updated together: V <- qr(A V) per view. A is never formed,
+        A V is applied as Hw (Hw^T V). Views are zero-padded to a common size so that the per-view
+        QR runs as one batched call. With `tol` set, iteration stops once the relative change of
+        the objective sum_ij tr(Vi^T Aij Vj) drops below it. The objective is tested every
+        `tol_every` iterations, against its value at the previous test, as every test synchronises
+        the host with the device.
+        """
+        dtype = self.dtype
+
+        v = len(X)
+
+        with torch.no_grad():
+            with span('whitening'):
+                d_list, s_list, siiRootInv_bd, Hw = self._whiten(X)
+            d_max = max(d_list)
+
+            # Row of every stacked feature in the padded (v, d_max) layout
+            pad_idx = torch.cat([torch.arange(d_list[i], device=self.device) + i * d_max for i in range(v)])
+            Hw_pad = torch.zeros(v * d_max, Hw.shape[1], device=self.device, dtype=dtype)
+            Hw_pad[pad_idx] = Hw
+
+            # Same start as the per-component solver for the leading direction, distinct columns for the rest
+            V = torch.zeros(v, d_max, self.dim, device=self.device, dtype=dtype)
+            for i in range(v):
+                V[i, :d_list[i], :] = torch.eye(d_list[i], self.dim, device=self.device, dtype=dtype)
+                V[i, :d_list[i], 0] = 1
+            V = self._orthonormalize(V)
+
+            obj = None
+            with span('power_iteration'):
+                for n in range(self.n_iter):
+                    HtV = torch.matmul(Hw_pad.t(), V.reshape(v * d_max, self.dim))
+                    V = self._orthonormalize(torch.matmul(Hw_pad, HtV).reshape(v, d_max, self.dim))
+
+                    if self.tol is not None and (n + 1) % self.tol_every == 0:
+                        obj_prev = obj
+                        obj = torch.sum(torch.matmul(Hw_pad.t(), V.reshape(v * d_max, self.dim)) ** 2)
+                        if obj_prev is not None and torch.abs(obj - obj_prev) <= self.tol * torch.abs(obj):
+                            break
+
+            V = V.reshape(v * d_max, self.dim)[pad_idx]
+            W = self._projections(siiRootInv_bd, V, d_list, s_list)
+
+        return self._output(X, W)
+
+    def loss_numpy_fast(self, X):
+        """
+        CPU backend of the multi-view DCC solve on LAPACK/BLAS through SciPy.
+
+        Xi Xi^T has rank <= m (the embedding size), so Sii = Xi Xi^T + rI has eigenvalue r on the
+        orthogonal complement of its top-m eigenvectors Ui. Only those are extracted (syevr with
+        subset_by_index) and Sii^-1/2 = r^-1/2 I + Ui (Di^-1/2 - r^-1/2) Ui^T is applied in factored
+        form. A = Hw Hw^T is then solved by the same per-view normalised power iteration as `loss`,
+        with the deflation S = A - P A, P = blockdiag(Vi Vi^T) of the components found so far, applied
+        per view as (I - Pi) Ai v instead of being formed. Components come out in the same order as
+        with `loss`, which returns the same (loss, W) up to rounding.
+        """
+        v = len(X)
+        np_dtype = np.float64 if self.dtype == torch.float64 else np.float32
+
+        d_list = []
+        s_list = []
+        d_sum = 0
+        for i in range(v):
+            d_list.append(X[i].shape[0])
+            s_list.append(d_sum)
+            d_sum += d_list[i]
+        rinv = self.r ** -0.5
+
+        Hw = np.empty((d_sum, X[0].shape[1]), dtype=np_dtype)
+        factors = []
+        with span('whitening'):
             for i in range(v):
                 di = d_list[i]
-                si = sum(d_list[0:i])
-                t = torch.matmul(siiRootInv[i], V[si:si+di, :])
-                Wn.append(t.cpu().detach().numpy())
-                W.append(t.float())
+                si = s_list[i]
+                xi = X[i].detach().cpu().numpy().astype(np_dtype)
+                k = min(xi.shape[1], di)
+
+                syrk = scipy.linalg.get_blas_funcs('syrk', (xi,))
+                sii = syrk(1.0, xi)
+                sii[np.diag_indices(di)] += self.r
+                D, U = scipy.linalg.eigh(sii, lower=False, subset_by_index=[di - k, di - 1], driver='evr',
+                                         overwrite_a=True, check_finite=False)
+                idx = D > self.eps
+                U = U[:, idx]
+                c = D[idx] ** -0.5 - rinv
+                factors.append((U, c))
 
-        corr = 0
+                # Sii^-1/2 xi without forming Sii^-1/2
+                Hw[si:si+di] = rinv * xi + U @ (c[:, None] * (U.T @ xi))
+
+        with span('a_assembly'):
+            A = Hw @ Hw.T
+
+        V = np.ones((d_sum, self.dim), dtype=np_dtype)
         for i in range(v):
-            for j in range(v):
-                sij = torch.matmul(X[i], X[j].t())
-                corr += torch.matmul(
-                    torch.matmul(W[i][:, 1].t(), sij), W[j][:, 1]
-                )
+            V[s_list[i]:s_list[i]+d_list[i]] /= np.sqrt(d_list[i])
 
-        return -torch.abs(corr), Wn
+        with span('power_iteration'):
+            for k in range(self.dim):
+                for n in range(self.n_iter):
+                    for i in range(v):
+                        di = d_list[i]
+                        si = s_list[i]
+
+                        y = A[si:si+di] @ V[:, k]
+                        if k > 0:
+                            vi = V[si:si+di, :k]
+                            y -= vi @ (vi.T @ y)
+                        V[si:si+di, k] = y / np.sqrt(np.sum(y ** 2))
+
+        W = []
+        for i in range(v):
+            di = d_list[i]
+            si = s_list[i]
+            U, c = factors[i]
+            vi = V[si:si+di]
+            t = rinv * vi + U @ (c[:, None] * (U.T @ vi))
+            W.append(torch.from_numpy(t).to(X[i].device))
+
+        return self._output(X, W)
+
+    def _orthonormalize(self, V):
+        # Zero padding rows stay zero under QR; fixing the sign of diag(R) keeps the columns
+        # from flipping between iterations.
+        Q, R = torch.linalg.qr(V)
+        sign = torch.sign(torch.diagonal(R, dim1=-2, dim2=-1))
+        sign = torch.where(sign == 0, torch.ones_like(sign), sign)
+        return Q * sign[:, None, :]
 
 class l21_loss():
     def __init__(self):
@@ -191,27 +431,56 @@ class l21_loss():
         return norm
 
 class safe_loss(nn.Module):
-    def __init__(self, class_num, device):
+    def __init__(self, class_num, device, kernel='exact', kernel_rank=256, bandwidth=None):
+        """
+        :param kernel: 'exact' builds the full N x N hidden kernel. 'nystrom' and 'rff' use a rank
+                       `kernel_rank` feature map Phi (Nystrom landmarks or random Fourier features) with
+                       K ~ Phi Phi^T, and never form the N x N matrix.
+        :param bandwidth: Bandwidth estimator of the hidden kernel (see `kernel.median_bandwidth`), the
+                          exact median if None
+        """
         super(safe_loss, self).__init__()
+        if kernel not in ('exact', 'nystrom', 'rff'):
+            raise ValueError("unknown kernel: {}".format(kernel))
         self.class_num = class_num
         self.device = device
+        self.kernel = kernel
+        self.kernel_rank = kernel_rank
+        self.bandwidth = bandwidth
+
+    def hidden_kernel(self, hidden):
+        if self.kernel == 'nystrom':
+            return nystrom_features(hidden, self.kernel_rank, rel_sigma=0.15, bandwidth=self.bandwidth)
+        elif self.kernel == 'rff':
+            return random_fourier_features(hidden, self.kernel_rank, rel_sigma=0.15, bandwidth=self.bandwidth)
+        return vector_kernel(hidden, rel_sigma=0.15, bandwidth=self.bandwidth)
 
     def forward_cluster(self, hidden, output, print_sign=False):
-        hidden_kernel = vector_kernel(hidden, rel_sigma=0.15)
-        l1 = self.DDC1(output, hidden_kernel, self.class_num)
-        l2 = self.DDC2(output)
-        l3 = self.DDC3(self.class_num, output, hidden_kernel)
-        if print_sign:
-            print(l1.item())
-            print(l2.item())
-            print(l3.item())
-        return l1+l2+l3, l1.item() + l2.item() + l3.item()
+        with span('safe_loss'):
+            n = self.class_num
+            # L_1 and L_3 share a single product with the hidden kernel
+            A = torch.cat([output, self.DDC3_assignments(n, output)], dim=1)
+            if self.kernel == 'exact':
+                nom = torch.t(A) @ gaussian_kernel_matmul(hidden, A, rel_sigma=0.15, bandwidth=self.bandwidth)
+            else:
+                nom = self.kernel_quad(A, self.hidden_kernel(hidden))
+            l1 = self.cs_divergence(nom[:n, :n], n)
+            l2 = self.DDC2(output)
+            l3 = self.cs_divergence(nom[n:, n:], n)
+            if print_sign:
+                print(l1.item())
+                print(l2.item())
+                print(l3.item())
+            loss = l1 + l2 + l3
+            # Detached rather than .item(), so that training does not wait on the device every step
+            return loss, loss.detach()
 
     "Adopted from https://github.com/DanielTrosten/mvc"
 
     def triu(self, X):
-        # Sum of strictly upper triangular part
-        return torch.sum(torch.triu(X, diagonal=1))
+        # Sum of strictly upper triangular part. X is symmetric everywhere it is used, so this is
+        # (sum(X) - tr(X)) / 2 without materialising the masked copy
+        return (torch.sum(X) - torch.trace(X)) / 2
 
     def _atleast_epsilon(self, X, eps=EPSILON):
         """
@@ -232,14 +501,29 @@ class safe_loss(nn.Module):
 
         :param A: Cluster assignment matrix
         :type A:  th.Tensor
-        :param K: Kernel matrix
+        :param K: Kernel matrix, or its feature map Phi for the low-rank kernels
         :type K: th.Tensor
         :param n_clusters: Number of clusters
         :type n_clusters: int
         :return: CS-divergence
         :rtype: th.Tensor
         """
-        nom = torch.t(A) @ K @ A
+        return self.cs_divergence(self.kernel_quad(A, K), n_clusters)
+
+    def kernel_quad(self, A, K):
+        """
+        A^T K A, from the kernel matrix or from its feature map Phi for the low-rank kernels.
+        """
+        if self.kernel == 'exact':
+            return torch.t(A) @ K @ A
+        # A^T K A = (A^T Phi)(Phi^T A), O(N m) instead of O(N^2)
+        P = torch.t(K) @ A
+        return torch.t(P) @ P
+
+    def cs_divergence(self, nom, n_clusters):
+        """
+        Cauchy-Schwarz divergence from the kernel quadratic form A^T K A.
+        """
         dnom_squared = torch.unsqueeze(torch.diagonal(nom), -1) @ torch.unsqueeze(torch.diagonal(nom), 0)
 
         nom = self._atleast_epsilon(nom)
@@ -259,7 +543,9 @@ class safe_loss(nn.Module):
         L_2 loss from DDC
         """
         n = output.size(0)
-        return 2 / (n * (n - 1)) * self.triu(output @ torch.t(output))
+        # triu(O O^T) = (||O^T 1||^2 - ||O||_F^2) / 2, O(N k) instead of the N x N Gram matrix
+        col_sum = torch.sum(output, dim=0)
+        return 2 / (n * (n - 1)) * (col_sum @ col_sum - torch.sum(output ** 2)) / 2
 
     def DDC2Flipped(self, output, n_clusters):
         """
@@ -272,8 +558,10 @@ class safe_loss(nn.Module):
         """
         L_3 loss from DDC
         """
+        m = self.DDC3_assignments(n_clusters, output)
+        return self.d_cs(m, hidden_kernel, n_clusters)
 
+    def DDC3_assignments(self, n_clusters, output):
         eye = torch.eye(n_clusters, device=self.device)
 
-        m = torch.exp(-cdist(output, eye))
-        return self.d_cs(m, hidden_kernel, n_clusters)
\ No newline at end of file
+        return torch.exp(-cdist(output, eye))
\ No newline at end of file
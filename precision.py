@@ -0,0 +1,80 @@
+import contextlib
+import torch
+
+DTYPES = {16: torch.float16, 'bf16': torch.bfloat16, 32: torch.float32, 64: torch.float64}
+
+
+class PrecisionPolicy():
+    """
+    Per stage precision of the SDCC model.
+
+    The Encoder/Decoder and DDC MLPs run under autocast in `mlp_dtype`, the covariation solve in
+    `solver_dtype`, and the fusion, gate and the decoder and clustering losses in float32. Tensors
+    only change dtype at the stage boundaries: on leaving an autocast region (`output`) and on
+    entering the solvers, which cast their inputs to `solver_dtype` themselves.
+
+    :param device: Device the model runs on, selects the autocast backend
+    :param mlp_dtype: torch.float16 or torch.bfloat16 to autocast the MLPs, None or torch.float32 for
+                      full precision
+    :param solver_dtype: torch.float32 or torch.float64 for the whitening and eigen-solves
+    """
+    def __init__(self, device=torch.device('cpu'), mlp_dtype=None, solver_dtype=torch.float32):
+        if mlp_dtype == torch.float32:
+            mlp_dtype = None
+        if mlp_dtype not in (None, torch.float16, torch.bfloat16):
+            raise ValueError("mlp_dtype must be float16, bfloat16 or float32, got {}".format(mlp_dtype))
+        if solver_dtype not in (torch.float32, torch.float64):
+            raise ValueError("solver_dtype must be float32 or float64, got {}".format(solver_dtype))
+        self.device_type = torch.device(device).type
+        self.mlp_dtype = mlp_dtype
+        self.solver_dtype = solver_dtype
+
+    def mlp(self):
+        """
+        Context for the MLP stages, autocast in `mlp_dtype` or a no-op at full precision.
+        """
+        if self.mlp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.mlp_dtype)
+
+    def output(self, *tensors):
+        """
+        float32 versions of the outputs of an MLP stage, no copy when already float32.
+        """
+        return tuple(t.float() for t in tensors)
+
+    def grad_scaler(self):
+        """
+        Loss scaler for the optimizer steps, only enabled for float16 whose gradients can underflow.
+        Before torch 2.3 there is only the CUDA scaler, float16 on the CPU then runs unscaled.
+        """
+        enabled = self.mlp_dtype == torch.float16
+        if hasattr(torch.amp, 'GradScaler'):
+            return torch.amp.GradScaler(self.device_type, enabled=enabled)
+        return torch.cuda.amp.GradScaler(enabled=enabled and self.device_type == 'cuda')
+
+    def adam(self, params, lr, weight_decay=0):
+        """
+        Adam for the MLP parameters, fused where the device supports it (CUDA, and the CPU from torch 2.4
+        on). A fused step can be skipped on the device through `found_inf`, see `skip_if_nonfinite`.
+        """
+        params = list(params)
+        try:
+            return torch.optim.Adam(params, lr=lr, weight_decay=weight_decay, fused=True)
+        except RuntimeError:
+            return torch.optim.Adam(params, lr=lr, weight_decay=weight_decay)
+
+    @staticmethod
+    def skip_if_nonfinite(optimizer, loss):
+        """
+        Make the next step of `optimizer` a no-op if `loss` is not finite. Fused Adam skips the update on
+        the device, as it does on the inf/NaN flag of an enabled loss scaler, so the host never waits. An
+        unfused optimizer needs the flag on the host first.
+
+        :return: False if the step has to be left out by the caller
+        """
+        finite = torch.isfinite(loss.detach())
+        if optimizer.defaults.get('fused'):
+            optimizer.found_inf = (~finite).float()
+            return True
+        return bool(finite)
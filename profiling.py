@@ -0,0 +1,162 @@
+"""
+Named timing spans of the SDCC stages.
+
+    with profiling.span('whitening'):
+        ...
+
+Spans are recorded by the active Profiler (see `Profiler.activate`), and cost a single function call
+while none is active. Spans may nest, their times are inclusive. A Profiler aggregates the spans of
+every epoch (count, host time and, on CUDA, device time from events), writes one JSON line per epoch
+to its sink and can capture a Chrome trace of a few epochs with torch.profiler, in which the spans
+show up as labelled ranges.
+"""
+import contextlib
+import json
+import threading
+import time
+from collections import defaultdict
+import torch
+
+_active = None
+_disabled = contextlib.nullcontext()
+
+
+def span(name, host=False):
+    """
+    Time the enclosed block as stage `name`.
+
+    :param host: Host-only stage (e.g. metrics on the evaluation thread), no device events
+    """
+    if _active is None:
+        return _disabled
+    return _active.span(name, host)
+
+
+class _Span():
+    def __init__(self, profiler, name, host):
+        self.profiler = profiler
+        self.name = name
+        self.events = profiler.cuda and not host
+
+    def __enter__(self):
+        if self.profiler.tracing:
+            self.range = torch.profiler.record_function(self.name)
+            self.range.__enter__()
+        if self.events:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        end_event = None
+        if self.events:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+        if self.profiler.tracing:
+            self.range.__exit__(*exc)
+        self.profiler.record(self.name, elapsed, (self.start_event, end_event) if self.events else None)
+        return False
+
+
+class Profiler():
+    """
+    Per-epoch aggregation of the spans.
+
+    Without synchronisation, the host time of a span on CUDA only covers launching its kernels, so
+    spans there also record CUDA events, which are resolved once per epoch into device times.
+
+    :param device: Device the model runs on
+    :param sink: Path of a JSONL file, one record of the span aggregates per epoch
+    :param trace: Path of a Chrome trace (chrome://tracing, Perfetto) of `trace_epochs` epochs
+    :param trace_wait: Epochs to skip before the traced ones, the first is also used as warmup
+    """
+    def __init__(self, device=torch.device('cpu'), sink=None, trace=None, trace_epochs=2, trace_wait=1):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.sink = open(sink, 'a') if sink is not None else None
+        self.lock = threading.Lock()
+        self.spans = defaultdict(list)
+        self.totals = defaultdict(lambda: dict(count=0, host=0., device=None))
+        self.trace = None
+        if trace is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=max(trace_wait - 1, 0), warmup=min(trace_wait, 1),
+                                                 active=trace_epochs, repeat=1),
+                on_trace_ready=lambda prof: prof.export_chrome_trace(trace))
+            self.trace.start()
+
+    @property
+    def tracing(self):
+        return self.trace is not None
+
+    def span(self, name, host=False):
+        return _Span(self, name, host)
+
+    def record(self, name, elapsed, events=None):
+        with self.lock:
+            self.spans[name].append((elapsed, events))
+
+    @contextlib.contextmanager
+    def activate(self):
+        """
+        Make this the profiler that `span` records to.
+        """
+        global _active
+        previous, _active = _active, self
+        try:
+            yield self
+        finally:
+            _active = previous
+
+    def epoch(self, **info):
+        """
+        Aggregate the spans recorded since the last call, e.g. at the end of an epoch. Waits for the
+        device if spans recorded events.
+
+        :param info: Identification of the epoch, written to the sink with the aggregates
+        :return: {name: {'count', 'host', 'device'}}, times in seconds, device None without events
+        """
+        with self.lock:
+            spans, self.spans = self.spans, defaultdict(list)
+        if self.cuda and spans:
+            torch.cuda.synchronize()
+        stages = {}
+        for name, records in spans.items():
+            events = [e for _, e in records if e is not None]
+            stage = dict(count=len(records), host=sum(t for t, _ in records),
+                         device=sum(s.elapsed_time(e) for s, e in events) / 1000 if events else None)
+            stages[name] = stage
+            total = self.totals[name]
+            total['count'] += stage['count']
+            total['host'] += stage['host']
+            if stage['device'] is not None:
+                total['device'] = (total['device'] or 0.) + stage['device']
+        if self.sink is not None:
+            self.sink.write(json.dumps(dict(info, stages=stages)) + '\n')
+            self.sink.flush()
+        if self.trace is not None:
+            self.trace.step()
+        return stages
+
+    def summary(self):
+        """
+        One line with the total time of every stage over all epochs, longest first. The device time
+        where the stage recorded events, otherwise (on CPU, host-only spans) the host time.
+        """
+        times = {name: total['host'] if total['device'] is None else total['device']
+                 for name, total in self.totals.items()}
+        stages = sorted(self.totals.items(), key=lambda item: -times[item[0]])
+        return ', '.join('{}: {:.2f}s ({:d})'.format(name, times[name], total['count']) for name, total in stages)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
@@ -0,0 +1,470 @@
+"""
+Dataset registry, readers and binary cache.
+
+A registered dataset is read through the reader of its source format: .mat (v5 and v7.3/HDF5),
+.h5/.hdf5, .npz or a directory of .npy files. The readers stream every view in blocks of samples,
+so a view is written straight into its destination (the cache, pinned host or device memory)
+without a second full copy on the host.
+
+Every registered dataset is converted once into one .npy file per view plus the labels and a
+manifest.json, under `<cache root>/<name>/`. Later loads memory-map those files and wrap them with
+torch.from_numpy, so no parsing or copying happens at startup.
+
+    python sdcc_data.py convert Caltech
+"""
+import argparse
+import ast
+import json
+import os
+import struct
+import zipfile
+import numpy as np
+import torch
+from scipy.io import loadmat, whosmat
+
+CACHE_ROOT = './dataset/cache'
+MANIFEST = 'manifest.json'
+# Bumped whenever the cache layout changes, older caches are rebuilt
+CACHE_VERSION = 1
+
+# Bytes per block of samples when streaming a view
+CHUNK_BYTES = 32 * 2**20
+
+
+def chunk_rows_for(shape, itemsize=8):
+    """
+    Samples per block of a view of `shape`, so that a block of float64 stays below CHUNK_BYTES.
+    """
+    return max(1, CHUNK_BYTES // (max(1, shape[1] if len(shape) > 1 else 1) * itemsize))
+
+# name -> source path and the keys of its views ('X1', 'X2', ...) and labels. A dataset is looked
+# up by prefix, so 'Caltech-5v' resolves to 'Caltech'.
+DATASETS = {
+    'Caltech': dict(path='./dataset/Caltech/Caltech_pca98.mat', view_key='X{}', label_key='Label'),
+}
+
+
+def register_dataset(name, path, view_key='X{}', label_key='Label', format=None, transpose=None):
+    """
+    Register a dataset whose views are stored as `view_key.format(i)`, i = 1..n_view.
+
+    :param path: .mat, .h5/.hdf5 or .npz file, or a directory of `<key>.npy` files
+    :param view_key: Variable, dataset, member or file name of the views
+    :param label_key: Same for the labels
+    :param format: 'mat', 'hdf5', 'npz' or 'npy', detected from `path` if None
+    :param transpose: Whether the views are stored (d_v, N). If None, True for MATLAB v7.3 files,
+                      which store the transpose of the MATLAB matrix, False otherwise
+    """
+    DATASETS[name] = dict(path=path, view_key=view_key, label_key=label_key, format=format, transpose=transpose)
+
+
+class MatReader():
+    """
+    MATLAB v5 files through scipy. The format can not be read partially, so a view is loaded on
+    its own when it is first streamed.
+    """
+    def __init__(self, path, transpose=False):
+        self.path = path
+        self.transpose = transpose
+        self.variables = {name: shape for name, shape, _ in whosmat(path)}
+
+    def has(self, key):
+        return key in self.variables
+
+    def shape(self, key):
+        shape = self.variables[key]
+        return tuple(shape[::-1]) if self.transpose else tuple(shape)
+
+    def read(self, key):
+        x = loadmat(self.path, variable_names=[key])[key]
+        return x.T if self.transpose else x
+
+    def chunks(self, key, chunk_rows):
+        x = self.read(key)
+        for start in range(0, x.shape[0], chunk_rows):
+            yield start, x[start:start + chunk_rows]
+
+    def close(self):
+        pass
+
+
+class HDF5Reader():
+    """
+    MATLAB v7.3 and other HDF5 files through h5py, read in blocks of samples.
+    """
+    def __init__(self, path, transpose=False):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("reading {} needs h5py (pip install h5py)".format(path))
+        self.file = h5py.File(path, 'r')
+        self.transpose = transpose
+
+    def has(self, key):
+        return key in self.file
+
+    def shape(self, key):
+        shape = self.file[key].shape
+        return tuple(shape[::-1]) if self.transpose else tuple(shape)
+
+    def read(self, key):
+        x = self.file[key][()]
+        return x.T if self.transpose else x
+
+    def chunks(self, key, chunk_rows):
+        ds = self.file[key]
+        for start in range(0, self.shape(key)[0], chunk_rows):
+            if self.transpose:
+                yield start, ds[:, start:start + chunk_rows].T
+            else:
+                yield start, ds[start:start + chunk_rows]
+
+    def close(self):
+        self.file.close()
+
+
+def _npy_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    if version == (2, 0):
+        return np.lib.format.read_array_header_2_0(f)
+    if version == (3, 0):
+        # 2.0 with a utf-8 header, which numpy has no public reader for
+        length = struct.unpack('<I', f.read(4))[0]
+        header = ast.literal_eval(f.read(length).decode('utf8'))
+        return tuple(header['shape']), header['fortran_order'], np.lib.format.descr_to_dtype(header['descr'])
+    raise ValueError("unsupported .npy format version {}.{}".format(*version))
+
+
+def _npy_chunks(f, chunk_rows, transpose):
+    """
+    Blocks of samples of the .npy stream `f`, read sequentially with plain reads, so that neither
+    the whole array nor a memory map of it is ever resident.
+    """
+    shape, fortran_order, dtype = _npy_header(f)
+    if len(shape) != 2 or fortran_order != transpose:
+        # Samples are not contiguous in the file, fall back to the whole array. The header is already
+        # consumed, so the data is read on from here
+        x = np.frombuffer(f.read(), dtype=dtype).reshape(shape, order='F' if fortran_order else 'C')
+        x = x.T if transpose else x
+        for start in range(0, x.shape[0], chunk_rows):
+            yield start, x[start:start + chunk_rows]
+        return
+    n, d = shape[::-1] if transpose else shape
+    row_bytes = d * dtype.itemsize
+    for start in range(0, n, chunk_rows):
+        rows = min(chunk_rows, n - start)
+        yield start, np.frombuffer(f.read(rows * row_bytes), dtype=dtype).reshape(rows, d)
+
+
+class NpzReader():
+    """
+    .npz archives. Members are parsed from their .npy header and streamed in blocks of samples, also
+    when the archive is compressed.
+    """
+    def __init__(self, path, transpose=False):
+        self.zip = zipfile.ZipFile(path)
+        self.transpose = transpose
+        self.members = {name[:-4] for name in self.zip.namelist() if name.endswith('.npy')}
+
+    def has(self, key):
+        return key in self.members
+
+    def shape(self, key):
+        with self.zip.open(key + '.npy') as f:
+            shape = _npy_header(f)[0]
+        return tuple(shape[::-1]) if self.transpose else tuple(shape)
+
+    def read(self, key):
+        with self.zip.open(key + '.npy') as f:
+            x = np.lib.format.read_array(f)
+        return x.T if self.transpose else x
+
+    def chunks(self, key, chunk_rows):
+        with self.zip.open(key + '.npy') as f:
+            yield from _npy_chunks(f, chunk_rows, self.transpose)
+
+    def close(self):
+        self.zip.close()
+
+
+class NpyReader():
+    """
+    Directories of `<key>.npy` files, read in blocks of samples.
+    """
+    def __init__(self, path, transpose=False):
+        self.path = path
+        self.transpose = transpose
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def has(self, key):
+        return os.path.exists(self._file(key))
+
+    def shape(self, key):
+        with open(self._file(key), 'rb') as f:
+            shape = _npy_header(f)[0]
+        return tuple(shape[::-1]) if self.transpose else tuple(shape)
+
+    def read(self, key):
+        x = np.load(self._file(key))
+        return x.T if self.transpose else x
+
+    def chunks(self, key, chunk_rows):
+        with open(self._file(key), 'rb') as f:
+            yield from _npy_chunks(f, chunk_rows, self.transpose)
+
+    def close(self):
+        pass
+
+
+READERS = {'mat': MatReader, 'hdf5': HDF5Reader, 'npz': NpzReader, 'npy': NpyReader}
+
+
+def _is_hdf5(path):
+    # MATLAB v7.3 files are HDF5 files with a 512 byte user block
+    with open(path, 'rb') as f:
+        head = f.read(520)
+    return head[:8] == b'\x89HDF\r\n\x1a\n' or head[512:520] == b'\x89HDF\r\n\x1a\n'
+
+
+def open_reader(entry):
+    """
+    Reader of a registry entry, with the format detected from the path unless given.
+    """
+    path = entry['path']
+    format = entry.get('format')
+    transpose = entry.get('transpose')
+    if format is None:
+        ext = os.path.splitext(path)[1].lower()
+        if os.path.isdir(path):
+            format = 'npy'
+        elif ext == '.npz':
+            format = 'npz'
+        elif ext in ('.h5', '.hdf5') or _is_hdf5(path):
+            format = 'hdf5'
+            if transpose is None:
+                transpose = ext == '.mat'
+        else:
+            format = 'mat'
+    if format not in READERS:
+        raise ValueError("unknown dataset format: {}".format(format))
+    return READERS[format](path, transpose=bool(transpose))
+
+
+def view_keys(reader, entry):
+    keys = []
+    while reader.has(entry['view_key'].format(len(keys) + 1)):
+        keys.append(entry['view_key'].format(len(keys) + 1))
+    return keys
+
+
+def read_labels(reader, entry):
+    lbl = np.asarray(reader.read(entry['label_key'])).ravel().astype(np.int64)
+    if lbl.min() == 1:
+        lbl = lbl - 1
+    return lbl
+
+
+def stream_view(chunks, shape, dtype=torch.float32, device=None, pin_memory=False):
+    """
+    Assemble a (N, d_v) view from blocks of samples directly in its destination.
+
+    Blocks for a CUDA device pass through two alternating pinned staging buffers, so that the copy
+    of one block overlaps reading the next. Host memory holds at most two blocks besides the
+    destination.
+
+    :param chunks: Iterable of (first sample, block) pairs
+    :param device: Destination device, the host if None
+    :param pin_memory: Allocate a host destination in pinned memory
+    """
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    cuda = device.type == 'cuda'
+    out = torch.empty(shape, dtype=dtype, device=device, pin_memory=pin_memory and not cuda)
+    # Blocks are copied through numpy views of the destination or of the staging buffers, which also
+    # casts them, so read-only blocks (memory maps, buffers) never need to be wrapped as tensors
+    direct = not cuda and dtype in (torch.float16, torch.float32, torch.float64)
+    staging = [None, None]
+    events = [None, None]
+    for i, (start, block) in enumerate(chunks):
+        dst = out[start:start + block.shape[0]]
+        if direct:
+            dst.numpy()[...] = block
+            continue
+        j = i % 2
+        if events[j] is not None:
+            events[j].synchronize()
+        if staging[j] is None or staging[j].numel() < block.size:
+            staging[j] = torch.empty(max(block.size, 1), dtype=torch.float64 if block.dtype == np.float64 else torch.float32,
+                                     pin_memory=cuda)
+        buf = staging[j][:block.size].view(block.shape)
+        buf.numpy()[...] = block
+        dst.copy_(buf, non_blocking=cuda)
+        if cuda:
+            events[j] = torch.cuda.Event()
+            events[j].record()
+    if cuda:
+        torch.cuda.current_stream(device).synchronize()
+    return out
+
+
+def resolve(dataset):
+    """
+    Registered name of `dataset`, the longest registered name it starts with.
+    """
+    names = [name for name in DATASETS if dataset.startswith(name)]
+    if not names:
+        raise ValueError("unknown dataset: {}".format(dataset))
+    return max(names, key=len)
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return dict(source=os.path.abspath(path), source_size=st.st_size, source_mtime=st.st_mtime)
+
+
+def _read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def convert(dataset, cache_root=CACHE_ROOT, dtype=np.float32):
+    """
+    Convert the source file of `dataset` into the binary cache.
+
+    The views are written as (N, d_v) arrays in `dtype`, the labels as int64 starting at 0. The
+    manifest is written last, so an interrupted conversion is never picked up as a valid cache.
+
+    :return: The manifest
+    """
+    name = resolve(dataset)
+    entry = DATASETS[name]
+    cache_dir = os.path.join(cache_root, name)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    reader = open_reader(entry)
+    views = []
+    try:
+        for key in view_keys(reader, entry):
+            file = 'view{}.npy'.format(len(views))
+            shape = reader.shape(key)
+            x = np.lib.format.open_memmap(os.path.join(cache_dir, file), mode='w+', dtype=dtype, shape=shape)
+            for start, block in reader.chunks(key, chunk_rows_for(shape)):
+                x[start:start + block.shape[0]] = block
+            x.flush()
+            del x
+            views.append(dict(file=file, shape=list(shape), dtype=np.dtype(dtype).name))
+        if not views:
+            raise ValueError("no views '{}' in {}".format(entry['view_key'], entry['path']))
+        lbl = read_labels(reader, entry)
+    finally:
+        reader.close()
+    np.save(os.path.join(cache_dir, 'label.npy'), lbl)
+
+    manifest = dict(version=CACHE_VERSION, name=name, views=views, label='label.npy', n_sample=int(lbl.shape[0]),
+                    n_class=int(lbl.max() + 1), **_source_stamp(entry['path']))
+    tmp = os.path.join(cache_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(cache_dir, MANIFEST))
+    return manifest
+
+
+def _cache_dtype(dtype):
+    return np.float64 if dtype == torch.float64 else np.float32
+
+
+def cached_manifest(dataset, cache_root=CACHE_ROOT, dtype=None):
+    """
+    Manifest of the cache of `dataset` if it exists and is up to date with the source file, else None.
+
+    :param dtype: Precision the views are loaded in. A cache narrower than that, e.g. float32 for a
+                  float64 load, is out of date as well, as upcasting it would not restore the source
+    """
+    name = resolve(dataset)
+    manifest = _read_manifest(os.path.join(cache_root, name))
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return None
+    if dtype is not None and any(np.dtype(view['dtype']).itemsize < np.dtype(_cache_dtype(dtype)).itemsize
+                                 for view in manifest['views']):
+        return None
+    path = DATASETS[name]['path']
+    if os.path.exists(path):
+        stamp = _source_stamp(path)
+        if any(manifest.get(k) != v for k, v in stamp.items()):
+            return None
+    return manifest
+
+
+def load(dataset, n_view, dtype=torch.float32, cache_root=CACHE_ROOT, cache=True, device=None, pin_memory=False,
+         chunk_rows=None):
+    """
+    Load the first `n_view` views of `dataset`, only those are read.
+
+    With `cache`, the dataset is converted into the cache first if needed. Host views are then
+    memory-mapped copy-on-write, so the returned tensors share the page cache with every other
+    process that loads the same dataset and are only copied when they are written to, or when `dtype`
+    differs from the cached dtype. A float32 cache is converted again for a float64 load, a float64
+    cache serves both. Without `cache`, or for a device or pinned destination, the views
+    are streamed in blocks of `chunk_rows` samples straight into their destination.
+
+    :param device: Device of the returned views, the host if None
+    :param pin_memory: Return host views in pinned memory
+    :param chunk_rows: Samples per streamed block, by default sized to CHUNK_BYTES
+    :return: Views, labels, number of samples, features of every view, number of classes
+    """
+    streamed = not cache or pin_memory or (device is not None and torch.device(device).type != 'cpu')
+    if cache:
+        manifest = cached_manifest(dataset, cache_root, dtype)
+        if manifest is None:
+            manifest = convert(dataset, cache_root, dtype=_cache_dtype(dtype))
+        entry = dict(path=os.path.join(cache_root, manifest['name']), view_key='view{}', label_key='label',
+                     format='npy')
+        keys = ['view{}'.format(i) for i in range(len(manifest['views']))]
+    else:
+        entry = DATASETS[resolve(dataset)]
+    reader = open_reader(entry)
+    try:
+        if not cache:
+            keys = view_keys(reader, entry)
+        if n_view > len(keys):
+            raise ValueError("{} has {} views, {} requested".format(dataset, len(keys), n_view))
+        data_list = []
+        for key in keys[:n_view]:
+            if streamed:
+                shape = reader.shape(key)
+                rows = chunk_rows or chunk_rows_for(shape)
+                x = stream_view(reader.chunks(key, rows), shape, dtype, device, pin_memory)
+            else:
+                x = torch.from_numpy(np.load(os.path.join(entry['path'], key + '.npy'), mmap_mode='c'))
+                x = x if x.dtype == dtype else x.to(dtype)
+            data_list.append(x)
+        lbl = np.load(os.path.join(entry['path'], 'label.npy')) if cache else read_labels(reader, entry)
+    finally:
+        reader.close()
+    N_sam_fea = [x.shape[1] for x in data_list]
+    return data_list, lbl, data_list[0].shape[0], N_sam_fea, int(lbl.max() + 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['convert', 'list'])
+    parser.add_argument('datasets', nargs='*')
+    parser.add_argument('--cache_root', default=CACHE_ROOT)
+    parser.add_argument('--dtype', default='float32')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        for dataset in args.datasets or list(DATASETS):
+            manifest = convert(dataset, args.cache_root, dtype=np.dtype(args.dtype))
+            print("{}: {} samples, {} classes, views {}".format(
+                manifest['name'], manifest['n_sample'], manifest['n_class'], [v['shape'][1] for v in manifest['views']]))
+    else:
+        for name, entry in DATASETS.items():
+            manifest = cached_manifest(name, args.cache_root)
+            print("{:<16}{:<48}{}".format(name, entry['path'], 'cached' if manifest is not None else '-'))
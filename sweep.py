@@ -0,0 +1,198 @@
+"""
+Seed and hyperparameter sweeps of main.main over a process pool.
+
+    python sweep.py --seeds 0 1 2 3 4 --grid lmbda=0.1,0.01 r=0.1,0.2 --workers 4 --out results.json
+
+The dataset is loaded once and moved to shared memory; the workers get it through the pool
+initializer, so every run reads the same tensors instead of loading or copying the dataset.
+Every grid point is run for every seed, the results file holds the single runs and the NMI/ACC/PUR
+mean and std per grid point.
+
+With --warm_start, grid points that only differ in fine-tune settings (main.FINETUNE_KEYS) share the
+phase-1 models and features of each seed, which are trained once by the first of them.
+"""
+import argparse
+import ast
+import copy
+import itertools
+import json
+import logging
+import os
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import main as sdcc
+from utils import load_mv_dataset
+
+_data = None
+_base_config = None
+
+
+def parse_grid(items):
+    """
+    Grid from `key=v1,v2,...` items, values are Python literals. Keys must be config keys.
+    """
+    grid = {}
+    for item in items:
+        key, _, values = item.partition('=')
+        if key not in sdcc.config:
+            raise ValueError("unknown config key: {}".format(key))
+        grid[key] = [ast.literal_eval(v) for v in values.split(',')]
+    return grid
+
+
+def grid_points(grid):
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+
+def _init_worker(data, base_config, n_threads, quiet):
+    global _data, _base_config
+    _data = data
+    # With fork this is the worker's own main.config, which every run resets
+    _base_config = copy.deepcopy(base_config)
+    torch.set_num_threads(n_threads)
+    if quiet:
+        # Before Solver configures logging, so that the per-epoch info lines are dropped
+        logging.basicConfig(level=logging.WARNING)
+
+
+def _reset_config(params):
+    sdcc.config.clear()
+    sdcc.config.update(copy.deepcopy(_base_config))
+    sdcc.config.update(params)
+
+
+def run(params, seed_idx):
+    """
+    One training run of the worker's dataset with the config overrides `params`.
+    """
+    X, lbl, N_sample, N_sam_fea, n_class = _data
+    _reset_config(params)
+    sdcc.set_seed(sdcc.seed_list[seed_idx])
+    ts = time.time()
+    # fit moves the views to the device in place, so every run gets its own list
+    nmi, pur, acc, ep = sdcc.main(list(X), lbl, N_sample, N_sam_fea, n_class, times=seed_idx)
+    return dict(params=params, seed=int(seed_idx), nmi=float(nmi), acc=float(acc), pur=float(pur), ep=int(ep),
+                time=time.time() - ts)
+
+
+def run_ensemble(params, seed_idxs):
+    """
+    All seeds of a grid point as one batched run, see main.main_ensemble.
+    """
+    X, lbl, N_sample, N_sam_fea, n_class = _data
+    _reset_config(params)
+    ts = time.time()
+    results = sdcc.main_ensemble(list(X), lbl, N_sample, N_sam_fea, n_class,
+                                 [sdcc.seed_list[i] for i in seed_idxs], times=seed_idxs[0])
+    t = (time.time() - ts) / len(seed_idxs)
+    return [dict(params=params, seed=int(i), nmi=float(nmi), acc=float(acc), pur=float(pur), ep=int(ep), time=t)
+            for i, (nmi, pur, acc, ep) in zip(seed_idxs, results)]
+
+
+def summarize(runs, points):
+    summary = []
+    for params in points:
+        rs = [r for r in runs if r['params'] == params]
+        row = dict(params=params, n_runs=len(rs))
+        for key in ('nmi', 'acc', 'pur'):
+            values = np.array([r[key] for r in rs])
+            row[key + '_mean'] = float(values.mean()) if len(rs) else float('nan')
+            row[key + '_std'] = float(values.std()) if len(rs) else float('nan')
+        summary.append(row)
+    return summary
+
+
+def phase1_leaders(points):
+    """
+    Split the grid points into the first point of every group that shares its phase-1 artifacts, and
+    the rest of the points.
+    """
+    leaders, rest, seen = [], [], set()
+    for params in points:
+        key = sdcc.fingerprint(sdcc.FINETUNE_KEYS, dict(sdcc.config, **params))
+        (rest if key in seen else leaders).append(params)
+        seen.add(key)
+    return leaders, rest
+
+
+def sweep(data, points, seeds, workers, n_threads=1, quiet=True, ensemble=False):
+    """
+    Run every grid point for every seed index across `workers` processes. With `ensemble`, the seeds
+    of a grid point are trained together in one task.
+
+    :param data: Output of utils.load_mv_dataset
+    :param points: List of config override dicts
+    :param seeds: Indices into main.seed_list
+    :return: Results of the single runs
+    """
+    X, lbl, N_sample, N_sam_fea, n_class = data
+    X = [x.share_memory_() for x in X]
+    data = (X, lbl, N_sample, N_sam_fea, n_class)
+    # fork inherits the shared tensors directly, spawn receives them as shared memory handles. CUDA
+    # cannot be initialised again in a forked child, so runs on CUDA always spawn their workers.
+    devices = [str(params.get('device', sdcc.config['device'])) for params in points]
+    cuda = any(device.startswith('cuda') for device in devices)
+    method = 'fork' if 'fork' in mp.get_all_start_methods() and not cuda else 'spawn'
+    runs = []
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context(method), initializer=_init_worker,
+                             initargs=(data, sdcc.config, n_threads, quiet)) as pool:
+        if ensemble:
+            waves = [[(run_ensemble, params, seeds) for params in points]]
+        elif sdcc.config['warm_start'] is not None:
+            # The points sharing phase-1 artifacts only start once their leader has written them
+            leaders, rest = phase1_leaders(points)
+            waves = [[(run, params, seed) for params in wave for seed in seeds] for wave in (leaders, rest)]
+        else:
+            waves = [[(run, params, seed) for params in points for seed in seeds]]
+        for wave in waves:
+            for future in [pool.submit(*task) for task in wave]:
+                rs = future.result()
+                for r in rs if ensemble else [rs]:
+                    print("{} - seed {} - NMI: {:.4f} - ACC: {:.4f} - PUR: {:.4f} - epoch: {} - time: {:.1f}s".format(
+                        r['params'], r['seed'], r['nmi'], r['acc'], r['pur'], r['ep'], r['time']))
+                    runs.append(r)
+    return runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', type=int, nargs='+', default=list(range(len(sdcc.seed_list))),
+                        help='indices into main.seed_list')
+    parser.add_argument('--grid', nargs='*', default=[],
+                        help='config overrides to sweep, e.g. lmbda=0.1,0.01 r=0.1,0.2 dim=20,40 n_iter=10')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--dataset', default=sdcc.config['dataset'])
+    parser.add_argument('--out', default='results.json')
+    parser.add_argument('--ensemble', action='store_true',
+                        help='train the seeds of every grid point as one batched ensemble')
+    parser.add_argument('--checkpoint_dir', default=None, help='checkpoint every run, resume finished or interrupted runs')
+    parser.add_argument('--warm_start', default=None,
+                        help='directory of phase-1 artifacts shared by grid points differing in fine-tune settings')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    sdcc.config['device'] = args.device
+    sdcc.config['dataset'] = args.dataset
+    sdcc.config['checkpoint_dir'] = args.checkpoint_dir
+    sdcc.config['warm_start'] = args.warm_start
+    points = grid_points(parse_grid(args.grid))
+    data = load_mv_dataset(args.dataset, sdcc.config['n_view'])
+
+    runs = sweep(data, points, args.seeds, args.workers, args.threads, quiet=not args.verbose, ensemble=args.ensemble)
+    summary = summarize(runs, points)
+
+    print("=====================================================")
+    for row in summary:
+        print('{}: NMI: {:.2f}+-{:.2f}%, ACC: {:.2f}+-{:.2f}%, PUR: {:.2f}+-{:.2f}% ({} runs)'.format(
+            row['params'], row['nmi_mean'] * 100, row['nmi_std'] * 100, row['acc_mean'] * 100,
+            row['acc_std'] * 100, row['pur_mean'] * 100, row['pur_std'] * 100, row['n_runs']))
+    with open(args.out, 'w') as f:
+        json.dump(dict(config=sdcc.config, seeds=args.seeds, grid=parse_grid(args.grid), runs=runs,
+                       summary=summary), f, indent=2, default=str)
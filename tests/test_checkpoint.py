@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import torch
+import main as sdcc
+
+
+class Crash(Exception):
+    pass
+
+
+def _data():
+    rng = np.random.default_rng(0)
+    N, dims, k = 120, [12, 16, 10, 14, 18], 3
+    lbl = rng.integers(0, k, N)
+    X = [torch.tensor(rng.normal(size=(k, d))[lbl] * 2 + rng.normal(size=(N, d)), dtype=torch.float32) for d in dims]
+    return X, lbl, N, dims, k
+
+
+@pytest.mark.parametrize('phase, epoch', [(1, 13), (2, 40)])
+def test_resume_with_whitening_cache(monkeypatch, tmp_path, phase, epoch):
+    monkeypatch.setitem(sdcc.config, 'device', 'cpu')
+    monkeypatch.setitem(sdcc.config, 'whitening_cache_tol', 0.3)
+    monkeypatch.setitem(sdcc.config, 'whitening_cache_every', 2)
+    X, lbl, N, dims, k = _data()
+    sdcc.set_seed(0)
+    reference = sdcc.main(list(X), lbl, N, dims, k)
+
+    monkeypatch.setitem(sdcc.config, 'checkpoint_dir', str(tmp_path))
+    monkeypatch.setitem(sdcc.config, 'checkpoint_every', 3)
+    profile_epoch = sdcc.Solver.profile_epoch
+
+    def crash(self, p, e, t):
+        profile_epoch(self, p, e, t)
+        if (p, e) == (phase, epoch):
+            raise Crash
+
+    monkeypatch.setattr(sdcc.Solver, 'profile_epoch', crash)
+    sdcc.set_seed(0)
+    with pytest.raises(Crash):
+        sdcc.main(list(X), lbl, N, dims, k)
+    monkeypatch.setattr(sdcc.Solver, 'profile_epoch', profile_epoch)
+    # The resumed run takes all of its state, the RNGs included, from the checkpoint
+    sdcc.set_seed(1)
+    assert sdcc.main(list(X), lbl, N, dims, k) == reference
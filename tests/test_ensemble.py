@@ -0,0 +1,22 @@
+import numpy as np
+import torch
+import main as sdcc
+
+
+def test_members_match_sequential_runs(monkeypatch):
+    # With cca_dim <= out_dim the covariation solve has no noise components (see EnsembleSolver)
+    monkeypatch.setitem(sdcc.config, 'device', 'cpu')
+    monkeypatch.setitem(sdcc.config, 'dim', 2)
+    rng = np.random.default_rng(0)
+    N, dims, k = 120, [12, 16, 10, 14, 18], 3
+    lbl = rng.integers(0, k, N)
+    X = [torch.tensor(rng.normal(size=(k, d))[lbl] * 2 + rng.normal(size=(N, d)), dtype=torch.float32) for d in dims]
+    seeds = [int(s) for s in sdcc.seed_list[:2]]
+
+    ensemble = sdcc.main_ensemble(list(X), lbl, N, dims, k, seeds)
+    sequential = []
+    for seed in seeds:
+        sdcc.set_seed(seed)
+        sequential.append(sdcc.main(list(X), lbl, N, dims, k))
+
+    np.testing.assert_allclose(np.array(ensemble), np.array(sequential))
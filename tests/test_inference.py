@@ -0,0 +1,35 @@
+import numpy as np
+import torch
+import main as sdcc
+from inference import Predictor
+
+
+def test_predictor_matches_last_training_assignments(monkeypatch, tmp_path):
+    monkeypatch.setitem(sdcc.config, 'device', 'cpu')
+    rng = np.random.default_rng(0)
+    N, dims, k = 120, [12, 16, 10, 14, 18], 3
+    lbl = rng.integers(0, k, N)
+    X = [torch.tensor(rng.normal(size=(k, d))[lbl] * 2 + rng.normal(size=(N, d)), dtype=torch.float32) for d in dims]
+    sdcc.set_seed(0)
+    models, solver_kwargs = sdcc.build(N, dims, k)
+    solver = sdcc.Solver(*models, **solver_kwargs)
+    solver.fit(list(X), lbl)
+
+    # Training scores the last epoch in train mode, with batch statistics in DDC and before its step
+    train = solver.pred.argmax(dim=1).numpy()
+    predictor = solver.export()
+    pred = predictor.predict([x.numpy() for x in X])
+    assert np.mean(pred == train) >= 0.98
+
+    predictor.save(tmp_path / 'model.pt')
+    np.testing.assert_array_equal(Predictor.load(tmp_path / 'model.pt').predict(X, batch_size=50), pred)
+
+
+def test_score_leaves_grad_mode_to_the_caller():
+    predictor = Predictor([4, 6], [1, 2], cca_dim=3, n_class=2, n_features=8)
+    batches = ([np.ones((5, 4), np.float32), np.ones((5, 6), np.float32)] for _ in range(3))
+    scores = predictor.score(batches)
+    for _ in range(3):
+        assert next(scores).shape == (5, 2)
+        assert not torch.is_inference_mode_enabled()
+        assert torch.is_grad_enabled()
@@ -0,0 +1,63 @@
+import pytest
+import torch
+from kernel import gaussian_kernel, gaussian_kernel_matmul
+
+SIGMA2 = 2.5
+
+
+def fixed_bandwidth(dist, rel_sigma, min_sigma):
+    # The median bandwidth is detached by design, a fixed one makes the kernel comparable to autograd
+    return dist.new_tensor(SIGMA2)
+
+
+def reference_kernel(x):
+    return torch.exp(-((x[:, None] - x[None]) ** 2).sum(dim=2) / (2 * SIGMA2))
+
+
+def inputs(n, duplicates):
+    g = torch.Generator().manual_seed(n)
+    x = torch.randn(n, 6, generator=g, dtype=torch.float64)
+    if duplicates:
+        x[1] = x[0]
+        x[-1] = x[n // 2]
+    return x, g
+
+
+@pytest.mark.parametrize('n, chunk_size', [(40, None), (40, 8), (37, 8), (37, 1), (10, 64)])
+@pytest.mark.parametrize('duplicates', [False, True])
+def test_gaussian_kernel_matches_autograd(n, chunk_size, duplicates):
+    x, g = inputs(n, duplicates)
+    weights = torch.randn(n, n, generator=g, dtype=torch.float64)
+
+    x_ref = x.clone().requires_grad_()
+    k_ref = reference_kernel(x_ref)
+    (k_ref * weights).sum().backward()
+
+    x = x.requires_grad_()
+    k = gaussian_kernel(x, bandwidth=fixed_bandwidth, chunk_size=chunk_size)
+    (k * weights).sum().backward()
+
+    torch.testing.assert_close(k, k_ref.detach())
+    torch.testing.assert_close(x.grad, x_ref.grad)
+
+
+@pytest.mark.parametrize('n, chunk_size', [(40, None), (40, 8), (37, 8), (37, 1)])
+@pytest.mark.parametrize('duplicates', [False, True])
+def test_gaussian_kernel_matmul_matches_autograd(n, chunk_size, duplicates):
+    x, g = inputs(n, duplicates)
+    A = torch.randn(n, 3, generator=g, dtype=torch.float64)
+    weights = torch.randn(n, 3, generator=g, dtype=torch.float64)
+
+    x_ref = x.clone().requires_grad_()
+    A_ref = A.clone().requires_grad_()
+    out_ref = reference_kernel(x_ref) @ A_ref
+    (out_ref * weights).sum().backward()
+
+    x = x.requires_grad_()
+    A = A.requires_grad_()
+    out = gaussian_kernel_matmul(x, A, bandwidth=fixed_bandwidth, chunk_size=chunk_size)
+    (out * weights).sum().backward()
+
+    torch.testing.assert_close(out, out_ref.detach())
+    torch.testing.assert_close(x.grad, x_ref.grad)
+    torch.testing.assert_close(A.grad, A_ref.grad)
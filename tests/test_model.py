@@ -0,0 +1,20 @@
+import copy
+import pytest
+import torch
+from SDCC_model import DCP
+
+
+def test_packed_encode_matches_per_view_loop():
+    torch.manual_seed(0)
+    N, dims = 64, [12, 16, 10, 14, 18]
+    x = [torch.randn(d, N) for d in dims]
+    model = DCP(N, 32, 2, len(dims), 2, 0.1, torch.device('cpu'))
+    packed = copy.deepcopy(model)
+    packed.packed = True
+
+    eo, dec_loss = model.encode(x, len(dims))
+    eo_packed, dec_loss_packed = packed.encode(x, len(dims))
+    for e, e_packed in zip(eo, eo_packed):
+        torch.testing.assert_close(e_packed, e, rtol=1e-5, atol=1e-6)
+    for loss, loss_packed in zip(dec_loss, dec_loss_packed):
+        assert loss_packed.item() == pytest.approx(loss.item(), rel=1e-5)
@@ -0,0 +1,22 @@
+import torch
+from profiling import Profiler
+
+
+class Event():
+    def __init__(self, ms=0.):
+        self.ms = ms
+
+    def elapsed_time(self, end):
+        return end.ms - self.ms
+
+
+def test_summary_uses_host_time_of_spans_without_events(monkeypatch):
+    monkeypatch.setattr(torch.cuda, 'synchronize', lambda: None)
+    profiler = Profiler()
+    # As on CUDA, where host-only spans (e.g. metrics) record no events
+    profiler.cuda = True
+    profiler.record('forward', 0.01, (Event(), Event(500.)))
+    profiler.record('metrics', 2.)
+    stages = profiler.epoch()
+    assert stages['metrics']['device'] is None
+    assert profiler.summary() == 'metrics: 2.00s (1), forward: 0.50s (1)'
@@ -0,0 +1,59 @@
+import zipfile
+import numpy as np
+import pytest
+import torch
+import sdcc_data
+from sdcc_data import NpzReader, load, register_dataset
+
+
+def _chunks(reader, key, chunk_rows):
+    return np.concatenate([x for _, x in reader.chunks(key, chunk_rows)])
+
+
+def test_npz_chunks_of_non_2d_members(tmp_path):
+    path = tmp_path / 'data.npz'
+    np.savez(path, Y=np.arange(10.), T=np.arange(24.).reshape(2, 3, 4))
+    reader = NpzReader(path)
+    np.testing.assert_array_equal(_chunks(reader, 'Y', 3), np.arange(10.))
+    np.testing.assert_array_equal(_chunks(reader, 'T', 1), np.arange(24.).reshape(2, 3, 4))
+
+
+@pytest.mark.parametrize('version', [(1, 0), (2, 0), (3, 0)])
+@pytest.mark.parametrize('transpose', [False, True])
+def test_npz_chunks_of_every_format_version(tmp_path, version, transpose):
+    x = np.arange(35, dtype=np.float32).reshape(7, 5)
+    path = tmp_path / 'data.npz'
+    with zipfile.ZipFile(path, 'w') as archive:
+        with archive.open('X.npy', 'w') as f:
+            np.lib.format.write_array(f, x, version=version)
+    reader = NpzReader(path, transpose)
+    assert reader.shape('X') == (x.T.shape if transpose else x.shape)
+    np.testing.assert_array_equal(_chunks(reader, 'X', 2), x.T if transpose else x)
+
+
+def test_npz_utf8_header(tmp_path):
+    # Format 3.0 exists for utf-8 headers, e.g. non-latin field names
+    x = np.zeros(4, dtype=[('λ', 'f8')])
+    path = tmp_path / 'data.npz'
+    with zipfile.ZipFile(path, 'w') as archive:
+        with archive.open('Y.npy', 'w') as f:
+            np.lib.format.write_array(f, x, version=(3, 0))
+    assert _chunks(NpzReader(path), 'Y', 2).dtype == x.dtype
+
+
+def test_float64_load_does_not_reuse_a_float32_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(sdcc_data, 'DATASETS', dict(sdcc_data.DATASETS))
+    rng = np.random.default_rng(0)
+    views = [rng.normal(size=(20, d)) for d in (3, 5)]
+    np.savez(tmp_path / 'source.npz', X1=views[0], X2=views[1], Label=np.arange(20) % 4)
+    register_dataset('Float64Test', str(tmp_path / 'source.npz'))
+    cache_root = str(tmp_path / 'cache')
+
+    X, _, _, _, _ = load('Float64Test', 2, torch.float32, cache_root)
+    assert X[0].dtype == torch.float32
+    X, _, _, _, _ = load('Float64Test', 2, torch.float64, cache_root)
+    for x, view in zip(X, views):
+        np.testing.assert_array_equal(x.numpy(), view)
+    # The float64 cache now also serves float32 loads
+    X, _, _, _, _ = load('Float64Test', 2, torch.float32, cache_root)
+    np.testing.assert_array_equal(X[0].numpy(), views[0].astype(np.float32))
@@ -2,33 +2,16 @@ import gzip
 from sklearn import svm
 from sklearn.metrics import accuracy_score
 import numpy as np
-from scipy.io import loadmat
 from sklearn.cluster import KMeans
 from sklearn import metrics, neighbors
-from metrics import accuracy
+from metrics2 import cluster_scores
 import torch
+import sdcc_data
 
-def load_mv_dataset(dataset, n_view, dtype=torch.float32):
+def load_mv_dataset(dataset, n_view, dtype=torch.float32, **kwargs):
+    # Registered datasets are converted to a memory-mapped cache on first use, see sdcc_data.load for the options
     print('loading data ...')
-    if dataset.startswith('Caltech'):
-        path = './dataset/Caltech/Caltech_pca98.mat'
-    else:
-        raise "unknown dataset"
-    data = loadmat(path)
-    data_list = []
-    for i in range(n_view):
-        x = data[f"X{i+1}"]
-        data_list.append(torch.tensor(x, dtype=dtype))
-    lbl = data['Label'].T
-    lbl = lbl[0]
-    if min(np.unique(lbl)) == 1:
-        lbl = lbl - 1
-    N_sam_fea = []
-    for i in range(n_view):
-        N_sam_fea.append(data_list[i].shape[1])
-    class_num = lbl.max() + 1
-    N_sample = data_list[0].shape[0]
-    return data_list, lbl, N_sample, N_sam_fea, class_num
+    return sdcc_data.load(dataset, n_view, dtype, **kwargs)
 
 def make_tensor(data_xy):
     """converts the input to numpy arrays"""
@@ -93,18 +76,11 @@ def clustering(lbl, x1, x2=None):
     n_class = ulbl.shape[0]
     kmeans = KMeans(n_clusters=n_class, random_state=0).fit(x)
     clbl = kmeans.labels_
-    import metrics2
-    nmi_score = metrics.normalized_mutual_info_score(labels_true=lbl, labels_pred=clbl)
-    pur_score = metrics2.purity_score(y_true=lbl, y_pred=clbl)#purity(labels_true=lbl, labels_pred=clbl)
-    acc_score = accuracy(labels_true=lbl, labels_pred=clbl)
-    return nmi_score, pur_score, acc_score
+    return cluster_eval(y_true=lbl, y_pred=clbl)
 
 def cluster_eval(y_true, y_pred):
-    import metrics2
-    nmi_score = metrics.normalized_mutual_info_score(labels_true=y_true, labels_pred=y_pred)
-    pur_score = metrics2.purity_score(y_true=y_true, y_pred=y_pred)
-    acc_score = accuracy(labels_true=y_true, labels_pred=y_pred)
-    return nmi_score, pur_score, acc_score
+    scores = cluster_scores(y_true, y_pred)
+    return scores['nmi'], scores['pur'], scores['acc']
 
 def purity_score(y_true, y_pred):
     # compute contingency matrix (also called confusion matrix)